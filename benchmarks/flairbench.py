@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+import argparse
+import collections
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import timeit
+
+from twisted.internet import defer, task
+
+from twobitbot import flair, flairstore, utils
+from twobitbot.utils import fixedpoint, ratelimit
+from twobitbot.benchmarks.replay import percentile
+
+log = logging.getLogger(__name__)
+
+# Load test for flair.Flair against a generated flair DB.
+#
+# Fills an sqlite flair DB with a given number of users and history rows, then drives change/status/top/history
+# calls from many concurrent clients through the reactor, and reports latency per call and overall throughput.
+# Give several row counts to see how each call scales with table size, e.g.
+#     python -m twobitbot.benchmarks.flairbench --users 10000 --rows 10000,100000,1000000,5000000
+
+
+class FixedPriceWatcher(object):
+    """Stand-in for an ExchangeWatcher with a constant spread around a price that can be moved."""
+
+    def __init__(self, price=600):
+        self.highestbid = price
+        self.lowestask = price + 1
+
+    def move(self, rand):
+        self.highestbid = max(1, self.highestbid + rand.randint(-100, 100) / 100.0)
+        self.lowestask = self.highestbid + 1
+
+
+class NoRateLimiter(ratelimit.BaseUserRateLimiter):
+    def _is_limited_predicate(self, user):
+        return False
+
+
+def populate(path, users, rows, seed=0, chunk=50000):
+    """Create a flair DB at path with `users` users and `rows` history rows, spread over the past year.
+    Each row flips its user's flair at a random walk price, so current flair and stats are consistent
+    with the history."""
+    rand = random.Random(seed)
+    conn = sqlite3.connect(path)
+    flairstore.SqliteFlairStore(path)._migrate(conn.cursor())
+
+    names = ['user%d' % (i) for i in xrange(users)]
+    current = dict()
+    stats = dict()
+    price = 60000
+    now = utils.now_in_utc_secs()
+    start = now - 365 * 24 * 60 * 60
+
+    def history():
+        price_cents = price
+        for i in xrange(rows):
+            price_cents = max(100, price_cents + rand.randint(-100, 100))
+            user = names[i % users] if i < users else rand.choice(names)
+            timestamp = start + (now - start) * i // max(rows, 1)
+            old = current.get(user)
+            if old is None:
+                if rand.random() < 0.5:
+                    row = (user, 'bull', price_cents, 0, fixedpoint.BTC_PIP, timestamp)
+                else:
+                    row = (user, 'bear', price_cents, price_cents, 0, timestamp)
+            elif old[1] == 'bear':
+                row = (user, 'bull', price_cents, 0, fixedpoint.usd_to_btc(old[3], price_cents), timestamp)
+            else:
+                row = (user, 'bear', price_cents, fixedpoint.btc_to_usd(old[4], price_cents), 0, timestamp)
+            if old is not None:
+                stats[user] = flairstore.add_trade_to_stats(stats.get(user, flairstore.NO_STATS),
+                                                            flairstore.trade_return_bp(old[1], old[2], price_cents))
+            current[user] = row
+            yield row
+
+    rows_left = history()
+    while True:
+        batch = [row for _, row in zip(xrange(chunk), rows_left)]
+        if not batch:
+            break
+        conn.executemany("""INSERT INTO ircflair(user, flairstatus, flairprice, usd_amount, btc_amount, timestamp)
+                         VALUES(?, ?, ?, ?, ?, ?)""", batch)
+    conn.executemany("""INSERT OR REPLACE INTO flair_current(user, flairstatus, flairprice, usd_amount,
+                     btc_amount, timestamp) VALUES(?, ?, ?, ?, ?, ?)""", current.itervalues())
+    conn.executemany("""INSERT OR REPLACE INTO flair_stats(user, trades, wins, best_bp, worst_bp, growth)
+                     VALUES(?, ?, ?, ?, ?, ?)""", ((user,) + tuple(s) for user, s in stats.iteritems()))
+    conn.commit()
+    conn.close()
+    return names
+
+
+class FlairBenchmark(object):
+    """Runs concurrent clients against a Flair and measures how long each call takes.
+
+    Calls are timed from when they are made until their Deferred fires. Writes happen in batches after
+    the calls that queued them have returned, so they are timed separately, as write batches. history
+    includes writing out queued updates first, as Flair.history does."""
+    # relative frequency of each call
+    default_mix = (('change', 2), ('status', 4), ('top', 2), ('history', 1))
+
+    def __init__(self, path, names, clients=50, ops=5000, mix=default_mix, seed=0, partial=0):
+        """partial: fraction of changes that only move part of a balance, leaving users holding BTC and USD."""
+        self.path = path
+        self.names = names
+        self.clients = clients
+        self.ops = ops
+        self.partial = partial
+        self.mix = [name for name, weight in mix for _ in xrange(weight)]
+        self.rand = random.Random(seed)
+        self.watcher = FixedPriceWatcher()
+        self.flair = None
+        self.latencies = collections.defaultdict(list)
+        self.write_latencies = list()
+        self.written = 0
+        self.load_time = 0
+        self.elapsed = 0
+        self._ops_left = 0
+
+    @defer.inlineCallbacks
+    def run(self, reactor):
+        start = timeit.default_timer()
+        self.flair = flair.Flair(self.watcher, self.path, ratelimiter=NoRateLimiter())
+        yield self.flair.loaded
+        yield self.flair.league().loaded
+        self.load_time = timeit.default_timer() - start
+        self._time_writes(self.flair.store)
+
+        self._ops_left = self.ops
+        start = timeit.default_timer()
+        yield defer.gatherResults([self._client(reactor) for _ in xrange(self.clients)])
+        self.elapsed = timeit.default_timer() - start
+        yield self.flair.stop()
+
+    def _time_writes(self, store):
+        write_batch = store.write_batch
+
+        def timed(batch):
+            started = timeit.default_timer()
+            d = write_batch(batch)
+
+            def done(result):
+                self.write_latencies.append(timeit.default_timer() - started)
+                self.written += len(batch)
+                return result
+            return d.addCallback(done)
+        store.write_batch = timed
+
+    @defer.inlineCallbacks
+    def _client(self, reactor):
+        while self._ops_left > 0:
+            self._ops_left -= 1
+            op = self.rand.choice(self.mix)
+            user = self.rand.choice(self.names)
+            if op == 'change':
+                self.watcher.move(self.rand)
+            started = timeit.default_timer()
+            yield self._call(op, user)
+            self.latencies[op].append(timeit.default_timer() - started)
+            # let the reactor run other clients, timers and finished DB queries before the next call
+            yield task.deferLater(reactor, 0, lambda: None)
+
+    def _call(self, op, user):
+        if op == 'change':
+            if self.rand.random() < self.partial:
+                return self.flair.change(user, self.rand.choice(('bull', 'bear')), percent=self.rand.randint(1, 99))
+            last = self.flair.league().latest.get(user.lower())
+            return self.flair.change(user, 'bull' if last is None or last.type == 'bear' else 'bear')
+        elif op == 'status':
+            return self.flair.status(user)
+        elif op == 'top':
+            return self.flair.top(self.rand.randint(1, flair.Flair.top_max), self.rand.randint(1, 5))
+        elif op == 'history':
+            return self.flair.history(user)
+        raise ValueError("Unknown flair call: %s" % (op))
+
+    def summary(self):
+        """Dict of load time, throughput, and (count, p50, p99) in ms for each call and for write batches."""
+        ret = {'load': self.load_time, 'ops_per_sec': self.ops / self.elapsed if self.elapsed else 0}
+        for op, latencies in sorted(self.latencies.items()) + [('write', self.write_latencies)]:
+            latencies = sorted(latencies)
+            ret[op] = (len(latencies), percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000)
+        return ret
+
+    def report(self):
+        summary = self.summary()
+        lines = ["load: %.3fs, %d calls from %d clients in %.3fs, %.0f calls/sec" %
+                 (summary['load'], self.ops, self.clients, self.elapsed, summary['ops_per_sec'])]
+        for op, _ in self.default_mix + (('write', 0),):
+            if op in summary:
+                lines.append("%-8s n=%-6d p50 %.3fms, p99 %.3fms" % ((op,) + summary[op]))
+        lines.append("%d flair updates written" % (self.written))
+        return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test flair against a generated flair DB.")
+    parser.add_argument('--users', type=int, default=10000, help="number of flair users")
+    parser.add_argument('--rows', default='100000',
+                        help="number of history rows, or a comma separated list to compare table sizes")
+    parser.add_argument('--clients', type=int, default=50, help="number of concurrent clients")
+    parser.add_argument('--ops', type=int, default=5000, help="number of calls to make")
+    parser.add_argument('--db', metavar='PATH',
+                        help="benchmark an existing flair DB instead of generating one (ignores --users/--rows)")
+    parser.add_argument('--partial', type=float, default=0,
+                        help="fraction of changes that move only part of a balance (0-1), to rank users holding both")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    from twisted.internet import reactor
+
+    tmpdir = tempfile.mkdtemp(prefix='flairbench')
+    results = list()
+
+    @defer.inlineCallbacks
+    def run_all():
+        try:
+            if args.db:
+                conn = sqlite3.connect(args.db)
+                names = [row[0] for row in conn.execute("SELECT user FROM flair_current")]
+                conn.close()
+                sizes = [(args.db, names, None)]
+            else:
+                sizes = list()
+                for rows in [int(r) for r in args.rows.split(',')]:
+                    path = os.path.join(tmpdir, 'flair%d.db' % (rows))
+                    started = timeit.default_timer()
+                    names = populate(path, args.users, rows, args.seed)
+                    print("generated %d users, %d rows in %.1fs" % (args.users, rows, timeit.default_timer() - started))
+                    sizes.append((path, names, rows))
+            for path, names, rows in sizes:
+                bench = FlairBenchmark(path, names, clients=args.clients, ops=args.ops, seed=args.seed,
+                                       partial=args.partial)
+                yield bench.run(reactor)
+                print("\n== %s ==" % ("%d rows" % (rows) if rows is not None else path))
+                print(bench.report())
+                results.append((rows, bench.summary()))
+            if len(results) > 1:
+                print("\n== p99 ms by table size ==")
+                print("%10s %9s" % ('rows', 'load s') + ''.join("%10s" % (op) for op, _ in FlairBenchmark.default_mix) +
+                      "%10s %10s" % ('write', 'calls/s'))
+                for rows, summary in results:
+                    print("%10d %9.3f" % (rows, summary['load']) +
+                          ''.join("%10.3f" % (summary[op][2]) for op, _ in FlairBenchmark.default_mix) +
+                          "%10.3f %10.0f" % (summary['write'][2], summary['ops_per_sec']))
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            reactor.stop()
+
+    reactor.callWhenRunning(run_all)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import logging
+import random
+import resource
+import sys
+import timeit
+from decimal import Decimal
+
+from twisted.internet import task
+
+from twobitbot import utils
+from twobitbot.bitstampwatcher import BitstampWatcher
+
+log = logging.getLogger(__name__)
+
+# Replays recorded exchange data through BitstampWatcher to benchmark the alert pipeline.
+#
+# Feeds are JSON lines of the form {"time": <ms>, "type": "trade"|"orderbook"|"liveorder", "data": {...}},
+# where data is what the corresponding bitcoinapis listener would have been called with.
+# Record one with `replay.py --record feed.jsonl`, or benchmark against generated data with --synthetic.
+
+
+class ReplayAPI(object):
+    """Stand-in for bitcoinapis.BitstampWSAPI that is driven from recorded events instead of the network."""
+
+    def __init__(self):
+        self.listeners = {'trade': list(), 'orderbook': list(), 'liveorder': list()}
+
+    def add_trade_listener(self, callback):
+        self.listeners['trade'].append(callback)
+
+    def add_orderbook_listener(self, callback):
+        self.listeners['orderbook'].append(callback)
+
+    def add_liveorder_listener(self, callback):
+        self.listeners['liveorder'].append(callback)
+
+    def emit(self, event_type, data):
+        for cb in self.listeners[event_type]:
+            # listeners may modify the data in place, like they can with live data
+            cb(dict(data))
+
+
+class FeedRecorder(object):
+    """Writes events from a live bitcoinapis API object to a feed file."""
+
+    def __init__(self, api, path):
+        self.out = open(path, 'w')
+        api.add_trade_listener(lambda data: self.record('trade', data))
+        api.add_orderbook_listener(lambda data: self.record('orderbook', data))
+
+    def record(self, event_type, data):
+        self.out.write(json.dumps({'time': utils.now_in_ms(), 'type': event_type, 'data': data},
+                                  default=float) + '\n')
+        self.out.flush()
+
+
+def load_feed(path):
+    with open(path) as f:
+        return [json.loads(line, parse_float=Decimal) for line in f if line.strip()]
+
+
+def synthetic_feed(trades, seed=0, start_price=Decimal('600')):
+    """Generate a random walk of trades with an orderbook snapshot every 10 trades.
+    Trades hit the best bid or ask of the last snapshot, so they can be told apart as buys and sells."""
+    rand = random.Random(seed)
+    price = book_price = start_price
+    burst = burst_side = 0
+    events = list()
+    for i in xrange(trades):
+        now = i * 50
+        price = max(Decimal('1'), price + Decimal(rand.randint(-100, 100)) / 100)
+        if i % 10 == 0:
+            book_price = price
+            events.append({'time': now, 'type': 'orderbook', 'data': {
+                'bids': [[price - Decimal(n) / 10, Decimal(rand.randint(1, 300))] for n in xrange(1, 21)],
+                'asks': [[price + Decimal(n) / 10, Decimal(rand.randint(1, 300))] for n in xrange(1, 21)]}})
+        # mostly small trades either way, with occasional one sided bursts of large ones so alerts fire
+        if burst == 0 and rand.random() < 0.005:
+            burst, burst_side = 20, rand.choice((1, -1))
+        if burst:
+            burst -= 1
+            amount = Decimal(rand.randint(1000, 2000)) / 100
+            side = burst_side
+        else:
+            amount = Decimal(rand.randint(1, 50)) / 100
+            side = rand.choice((1, -1))
+        trade_price = book_price + Decimal(side) / 10
+        events.append({'time': now, 'type': 'trade', 'data': {'price': trade_price, 'amount': amount}})
+    return events
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0
+    idx = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+class ReplayBenchmark(object):
+    """Feeds events into a BitstampWatcher and measures throughput, alert latency and memory.
+
+    Alert latency is in recorded time, from the trade that pushed the window's buy or sell volume over the
+    threshold to the volume check that alerted on it, so it shows what the check interval costs. Processing
+    time is wall time from a trade arriving to its alert going out."""
+
+    def __init__(self, events, triggervolume=100, check_interval=0, wall_threshold=0):
+        self.events = events
+        self.api = ReplayAPI()
+        self.now_ms = 0
+        self.check_interval = check_interval
+        self.watcher = BitstampWatcher(triggervolume=triggervolume, check_interval=check_interval,
+                                       wall_threshold=wall_threshold, api=self.api, clock=lambda: self.now_ms)
+        self.watcher.add_alert_callback(self.on_alert)
+        self.alerts = 0
+        # recorded ms, and wall secs
+        self.latencies = list()
+        self.processing = list()
+        self.trades = 0
+        self.elapsed = 0
+        self._trade = None
+        self._trade_at = None
+        self._crossed_at = None
+
+    def on_alert(self, msg):
+        self.alerts += 1
+        if self._trade is not None:
+            # alerted by the trade being dispatched
+            self.latencies.append(0)
+            self.processing.append(timeit.default_timer() - self._trade_at)
+        elif self._crossed_at is not None:
+            self.latencies.append(self.now_ms - self._crossed_at)
+        self._crossed_at = None
+
+    def dispatch(self, event):
+        self.now_ms = event['time']
+        if event['type'] != 'trade':
+            self.api.emit(event['type'], event['data'])
+            return
+        self.trades += 1
+        self._trade, self._trade_at = event, timeit.default_timer()
+        self.api.emit(event['type'], event['data'])
+        self._trade = None
+        orders = self.watcher.recentorders
+        if max(orders.buyvol, orders.sellvol) <= self.watcher.triggervolume:
+            self._crossed_at = None
+        elif self._crossed_at is None:
+            self._crossed_at = event['time']
+
+    def check(self, now_ms):
+        self.now_ms = now_ms
+        self.watcher.check_whale_marketorder()
+
+    def run(self):
+        """Replay every event as fast as possible. With a check interval, the periodic
+        volume check is simulated in recorded time rather than with the watcher's timer."""
+        if self.watcher.checker is not None and self.watcher.checker.running:
+            # still set, so trades are left for the checks below instead of being checked as they arrive
+            self.watcher.checker.stop()
+        next_check = None
+        start = timeit.default_timer()
+        for event in self.events:
+            if self.check_interval:
+                if next_check is None:
+                    next_check = event['time'] + self.check_interval * 1000
+                while event['time'] >= next_check:
+                    self.check(next_check)
+                    next_check += self.check_interval * 1000
+            self.dispatch(event)
+        self.elapsed = timeit.default_timer() - start
+
+    def run_scaled(self, reactor, speed=1.0):
+        """Replay events in real time through the reactor, with time sped up by `speed`.
+        Returns a Deferred that fires when the replay is done."""
+        start = timeit.default_timer()
+        first = self.events[0]['time'] if self.events else 0
+        if self.check_interval:
+            # the watcher's own timer runs in real time, so replace it with one that keeps up with the replay
+            self.watcher.checker.stop()
+            self.watcher.checker = task.LoopingCall(
+                lambda: self.check(first + int((timeit.default_timer() - start) * 1000 * speed)))
+            self.watcher.checker.start(self.check_interval / speed, now=False)
+        calls = [task.deferLater(reactor, (event['time'] - first) / 1000.0 / speed, self.dispatch, event)
+                 for event in self.events]
+
+        def done(_):
+            self.elapsed = timeit.default_timer() - start
+            if self.watcher.checker is not None:
+                self.watcher.checker.stop()
+        # deferLater calls run in scheduled order, so the last one finishing means all are done
+        d = calls[-1] if calls else task.deferLater(reactor, 0, lambda: None)
+        d.addCallback(done)
+        return d
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        processing = sorted(self.processing)
+        lines = ["events: %d, trades: %d, alerts: %d" % (len(self.events), self.trades, self.alerts),
+                 "elapsed: %.3fs, %.0f trades/sec" % (self.elapsed, self.trades / self.elapsed if self.elapsed else 0)]
+        if latencies:
+            lines.append("alert latency (recorded) ms: p50 %d, p90 %d, p99 %d, max %d" %
+                         tuple(percentile(latencies, p) for p in (50, 90, 99, 100)))
+        if processing:
+            lines.append("alert processing ms: p50 %.3f, p90 %.3f, p99 %.3f, max %.3f" %
+                         tuple(percentile(processing, p) * 1000 for p in (50, 90, 99, 100)))
+        # ru_maxrss is in KB on Linux
+        lines.append("peak memory: %.1f MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+        return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay exchange data through BitstampWatcher and benchmark it.")
+    parser.add_argument('feed', nargs='?', help="feed file (JSON lines) to replay")
+    parser.add_argument('--synthetic', type=int, metavar='TRADES', help="replay generated trades instead of a file")
+    parser.add_argument('--record', metavar='PATH', help="record the live Bitstamp feed to PATH instead of replaying")
+    parser.add_argument('--speed', type=float, default=0,
+                        help="replay in real time sped up by this factor, 0 (default) for full speed")
+    parser.add_argument('--threshold', type=int, default=100, help="volume alert threshold")
+    parser.add_argument('--interval', type=int, default=0, help="volume check interval (seconds), 0 for per-trade")
+    parser.add_argument('--wall-threshold', type=int, default=0, help="wall alert threshold, 0 to disable")
+    args = parser.parse_args()
+
+    from twisted.internet import reactor
+
+    if args.record:
+        import bitcoinapis
+        FeedRecorder(bitcoinapis.BitstampWSAPI(), args.record)
+        reactor.run()
+        return
+
+    if args.synthetic:
+        events = synthetic_feed(args.synthetic)
+    elif args.feed:
+        events = load_feed(args.feed)
+    else:
+        parser.error("a feed file or --synthetic is required")
+
+    bench = ReplayBenchmark(events, triggervolume=args.threshold, check_interval=args.interval,
+                            wall_threshold=args.wall_threshold)
+    if args.speed:
+        bench.watcher.clock = utils.now_in_ms
+        d = bench.run_scaled(reactor, args.speed)
+        d.addCallback(lambda _: reactor.stop())
+        reactor.run()
+    else:
+        bench.run()
+    print(bench.report())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
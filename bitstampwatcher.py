@@ -3,10 +3,13 @@
 from twisted.internet import task
 
 import logging
-import copy
-from collections import deque
 
 from twobitbot import utils
+from twobitbot.trades import RollingTradeWindow, Trade
+from twobitbot.orderbook import OrderBook
+from twobitbot.walls import WallTracker
+from twobitbot.liveorders import LiveOrderStore
+from twobitbot.exchangewatcher import ExchangeWatcher
 import bitcoinapis
 
 log = logging.getLogger(__name__)
@@ -14,8 +17,6 @@ log = logging.getLogger(__name__)
 
 # todo: replace dicts with trade objects
 # todo: move thresholds into config file
-# todo: add live_orders support
-# todo: add tracking for walls
 
 
 # temp class for integrating bitstampobserver
@@ -55,37 +56,50 @@ class BitstampAlerter(bitcoinapis.BitstampObserver):
         """"""
 
 
-class BitstampWatcher(object):
+class BitstampWatcher(ExchangeWatcher):
+    name = 'bitstamp'
 
-    def __init__(self, triggervolume=100):
+    def __init__(self, triggervolume=100, check_interval=0, wall_threshold=0, live_order_limit=0,
+                 api=None, clock=None):
+        """check_interval: seconds between periodic volume checks. If 0, volume is instead
+        checked on every trade, so alerts go out as soon as the triggering trade arrives.
+        wall_threshold: minimum BTC at one price level to alert on as a wall, 0 to disable.
+        live_order_limit: maximum number of open orders to track from the live orders stream, 0 to disable.
+        api: object providing the bitcoinapis listener interface, defaults to a new BitstampWSAPI.
+        clock: callable returning the current time in ms, used to timestamp trades."""
+        super(BitstampWatcher, self).__init__()
         self.triggervolume = triggervolume or 100
+        self.clock = clock or utils.now_in_ms
 
-        self._highestbid = None
-        self._lowestask = None
-
-        self.recentorders = deque()
-        self.orderbook = dict()
+        self.recentorders = RollingTradeWindow(timelimit_ms=15000)
+        self.orderbook = OrderBook()
         self.last_orderbook = None
+        self.walls = None
+        if wall_threshold:
+            self.walls = WallTracker(self.orderbook, wall_threshold, self.announce_wall)
 
-        self.alert_cbs = list()
-
-        self.api = bitcoinapis.BitstampWSAPI()
+        self.api = api or bitcoinapis.BitstampWSAPI()
         self.api.add_trade_listener(self.on_trade)
         self.api.add_orderbook_listener(self.on_orderbook)
-        #self.api.add_liveorder_listener('')
+        self.liveorders = None
+        if live_order_limit:
+            self.liveorders = LiveOrderStore(max_orders=live_order_limit)
+            self.api.add_liveorder_listener(self.on_liveorder)
 
-        self.checker = task.LoopingCall(self.check_whale_marketorder)
-        self.checker.start(10)
+        self.checker = None
+        if check_interval:
+            self.checker = task.LoopingCall(self.check_whale_marketorder)
+            self.checker.start(check_interval)
 
     @property
     def highestbid(self):
         if self._keep_orderbook_fresh():
-            return self._highestbid
+            return self.orderbook.best_bid()
 
     @property
     def lowestask(self):
         if self._keep_orderbook_fresh():
-            return self._lowestask
+            return self.orderbook.best_ask()
 
     def _keep_orderbook_fresh(self):
         """Check that the orderbook data is fresh.
@@ -99,10 +113,16 @@ class BitstampWatcher(object):
             return True
 
     def __del__(self):
-        if self.checker is not None:
+        if self.checker is not None and self.checker.running:
             self.checker.stop()
 
     def _tag_trade_buysell(self, order):
+        if self.liveorders is not None and 'buy_order_id' in order and 'sell_order_id' in order:
+            is_buy = self.liveorders.taker_is_buy(order['buy_order_id'], order['sell_order_id'])
+            if is_buy is not None:
+                order['is_buy'] = is_buy
+                return
+
         bid = self.highestbid
         ask = self.lowestask
 
@@ -119,7 +139,11 @@ class BitstampWatcher(object):
     def on_trade(self, data):
         """Callback, called when new bitstamp trade events
         Data persisted in self.bitstamp_recentorders"""
+        if self.walls is not None:
+            self.walls.on_trade(data['price'], data['amount'])
         self._tag_trade_buysell(data)
+        if self.trade_cbs:
+            self._send_trade(Trade(data['amount'], data['price'], utils.now_in_utc_ms(), data.get('is_buy')))
         if not 'is_buy' in data:
            # short circuit if not tagged buy/sell
             return
@@ -128,58 +152,56 @@ class BitstampWatcher(object):
             log.debug("trade event alerting on Bitstamp order: %.2f @ %.2f, is_buy: %s" %
                      (data['amount'], data['price'], data['is_buy']))
         else:
-            data['timestamp'] = utils.now_in_ms()
-            self.recentorders.appendleft(data)
+            self.recentorders.add(data['amount'], data['price'], self.clock(), data['is_buy'])
+            if self.checker is None:
+                self.check_whale_marketorder()
+            else:
+                self._clear_old_trades()
 
     def _clear_old_trades(self, timelimit_ms=15000):
         """This has to be called to get a time-limited view of recent trades.
         Parameters:
             timelimit_ms - removes all orders more than this many ms old, compared to the most recent order"""
-        if len(self.recentorders) > 0:
-            while self.recentorders[0]['timestamp'] - self.recentorders[-1]['timestamp'] > timelimit_ms:
-                self.recentorders.pop()
+        self.recentorders.timelimit_ms = timelimit_ms
+        self.recentorders.expire()
 
     def check_whale_marketorder(self):
-        # Avoid race condition with _trade_event removing orders??? no sure if important
-        # Not sure if this is the best method to do so.
-        # May not be necessary now that I removed the recentorders.clear() call in there
         self._clear_old_trades()
-        orders = copy.deepcopy(self.recentorders)
-
-        ordersum = sum([order['amount'] for order in orders])
+        orders = self.recentorders
 
         # this much btc or more to trigger an alert
-
-        if ordersum > self.triggervolume:
-            buyvol = sellvol = 0
-            high = low = 0
-
-            for order in orders:
-                if 'is_buy' in order and order['is_buy'] is True:
-                    buyvol += order['amount']
-                    if high == 0 or order['price'] > high:
-                        high = order['price']
-                elif 'is_buy' in order and order['is_buy'] is False:
-                    sellvol += order['amount']
-                    if low == 0 or order['price'] < low:
-                        low = order['price']
+        if orders.total > self.triggervolume:
+            buyvol, sellvol = orders.buyvol, orders.sellvol
+            high, low = orders.high, orders.low
 
             log.debug("ordersum %s, buyvol %s, sellvol %s, high %.2f, low %.2f" %
-                      (ordersum, buyvol, sellvol, high, low))
+                      (orders.total, buyvol, sellvol, high, low))
             if buyvol > self.triggervolume and buyvol/(buyvol+sellvol) > 0.8:
                 self.announce_whale_order({'amount': buyvol, 'price': high, 'is_buy': True})
-                self.recentorders.clear()
+                orders.clear()
             elif sellvol > self.triggervolume and sellvol/(buyvol+sellvol) > 0.8:
                 self.announce_whale_order({'amount': sellvol, 'price': low, 'is_buy': False})
-                self.recentorders.clear()
+                orders.clear()
+
+    def on_liveorder(self, data):
+        """Callback, called with live order events. Data is a dict with 'event' (order_created,
+        order_changed or order_deleted), and the order's 'id', 'price', 'amount', and 'order_type' (0 for buy)."""
+        try:
+            event = data['event']
+            if event == 'order_created':
+                self.liveorders.created(data['id'], data['price'], data['amount'], data['order_type'] == 0)
+            elif event == 'order_changed':
+                self.liveorders.changed(data['id'], data['amount'])
+            elif event == 'order_deleted':
+                self.liveorders.deleted(data['id'])
+        except KeyError:
+            log.warn("Bad live order data in on_liveorder: %s" % (data))
 
     def on_orderbook(self, data):
         """Callback, called when new bitstamp orderbook data available"""
-        self.orderbook = data
         if 'bids' in data and 'asks' in data and len(data['bids']) > 0 and len(data['asks']) > 0:
-            self._highestbid = data['bids'][0][0]
-            self._lowestask = data['asks'][0][0]
-            self.last_orderbook = utils.now_in_utc_secs()
+            self.orderbook.apply_snapshot(data['bids'], data['asks'])
+            self.last_orderbook = self.orderbook.last_update
         else:
             log.warn("Bad orderbook data in on_orderbook: %s" % (data))
 
@@ -201,20 +223,18 @@ class BitstampWatcher(object):
         # sendline won't accept unicode, but moved the encoding into the actual callbacks
         self._send_alert(ann)
 
-    def add_alert_callback(self, callback):
-        self.alert_cbs.append(callback)
-
-    def _send_alert(self, msg):
-        for cb in self.alert_cbs:
-            cb(msg)
-
-
-class Trade:
-    def __init__(self, amount=0, price=0, timestamp=None, is_buy=None):
-        self.amount = amount
-        self.price = price
-        self.timestamp = timestamp
-        self.is_buy = is_buy
+    def announce_wall(self, event, wall, amount):
+        """WallTracker alert callback. event is one of 'appeared', 'pulled' or 'eaten'."""
+        side = 'bid' if wall.is_bid else 'ask'
+        if event == 'appeared':
+            desc = u"%s BTC %s wall appeared" % (utils.truncatefloat(amount), side)
+        elif event == 'eaten':
+            desc = u"%s BTC %s wall eaten" % (utils.truncatefloat(amount), side)
+        else:
+            desc = u"%s BTC %s wall pulled" % (utils.truncatefloat(amount), side)
+        ann = u"Bitstamp alert | %s at $%0.2f" % (desc, wall.price)
+        log.info(ann.encode('utf8'))
+        self._send_alert(ann)
 
 
 def main():
@@ -8,6 +8,7 @@ from twisted.internet.protocol import ReconnectingClientFactory
 from twisted.words.protocols import irc
 
 from twobitbot.bitstampwatcher import BitstampWatcher
+from twobitbot.exchangewatcher import WatcherRegistry
 from twobitbot.utils import ratelimit, configure
 from twobitbot import botresponder
 
@@ -33,21 +34,20 @@ else:
 # TODO: refactor to make passing around exchanges and configuration easier/better.
 # TODO: Services
 # TODO: rethink logging
-# TODO: replace bitstampwatcher
 #####################
 
 log = logging.getLogger("ircbot")
 
 
 class TwoBitBotIRC(irc.IRCClient):
-    def __init__(self, config):
+    def __init__(self, config, exchanges, responder):
+        """exchanges and responder are shared by every connection the factory makes."""
         self.config = config
-
-        self.bitstamp = BitstampWatcher(triggervolume=self.config['volume_alert_threshold'])
+        self.exchanges = exchanges
         self.channels = list()
         self.broadcast_to_channels = list()
         #self.broadcast_to_users = list()
-        self.responder = botresponder.BotResponder(self.config, self.bitstamp)
+        self.responder = responder
 
     # todo this overwrites ircclient var
     @property
@@ -66,10 +66,14 @@ class TwoBitBotIRC(irc.IRCClient):
             log.critical("Problem joining channels sepecified in config file", exc_info=True)
 
         log.info("Signed on as %s." % (self.nickname))
-        self.bitstamp.add_alert_callback(self.broadcast_msg)
+        self.exchanges.add_alert_callback(self.broadcast_msg)
         # not really necessary
         self.responder.set_name(self.nickname)
 
+    def connectionLost(self, reason):
+        self.exchanges.remove_alert_callback(self.broadcast_msg)
+        irc.IRCClient.connectionLost(self, reason)
+
     def joined(self, channel):
         """Called when we finish joining a channel."""
         log.info("Joined %s." % (channel))
@@ -86,13 +90,14 @@ class TwoBitBotIRC(irc.IRCClient):
             # message directed just to us
             respond_to = user
             in_str = 'privmsg'
+            channel = None
         else:
             # message was sent to a channel
             respond_to = channel
             in_str = respond_to
 
         if self.can_reply(userhost):
-            response = yield self.responder.dispatch(msg, user)
+            response = yield self.responder.dispatch(msg, user, channel)
             if response:
                 log.debug("RESPOND to %s@%s in %s with '%s'" % (user, userhost, in_str, response.encode("utf8")))
                 self.msg(respond_to, response.encode("utf8"))
@@ -133,9 +138,17 @@ class TwoBitBotFactory(ReconnectingClientFactory):
         self.config = config
         self.ratelimiter = ratelimit.ExponentialRateLimiter(
             max_delay=5*60, base_factor=2, reset_after=30*60)
+        # built once rather than per connection, so reconnecting doesn't leave a second watcher, trade tape
+        # and candle store running against the same files
+        self.exchanges = WatcherRegistry()
+        self.exchanges.add(BitstampWatcher(triggervolume=self.config['volume_alert_threshold'],
+                                           check_interval=self.config['volume_alert_interval'],
+                                           wall_threshold=self.config['wall_alert_threshold'],
+                                           live_order_limit=self.config['live_order_limit']))
+        self.responder = botresponder.BotResponder(self.config, self.exchanges)
 
     def buildProtocol(self, addr):
-        proto = TwoBitBotIRC(self.config)
+        proto = TwoBitBotIRC(self.config, self.exchanges, self.responder)
         proto.factory = self
         return proto
 
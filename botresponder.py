@@ -6,7 +6,9 @@ from twisted.internet import defer
 import logging
 import datetime
 
-from twobitbot import utils, flair
+from twobitbot import utils, flair, tape, candles
+from twobitbot.commandrouter import CommandRouter, command
+from twobitbot.utils import geocache, tzresolver
 
 log = logging.getLogger(__name__)
 
@@ -21,46 +23,109 @@ class BotResponder(object):
             self.name = self.config['botname']
         except KeyError:
             self.name = None
-        self.flair = flair.Flair(self.exchange_watcher, flair_db=self.config['flair_db'])
+        self.flair = flair.Flair(self.exchange_watcher, flair_db=self.config['flair_db'],
+                                 mark_epsilon=self.config['flair_mark_epsilon'])
+        self.tape = None
+        if self.config['trade_tape']:
+            self.tape = tape.TradeTape(self.config['trade_tape'])
+            self.exchange_watcher.add_trade_callback(self.tape.record_trade)
+        self.candles = candles.CandleStore(self.config['candle_file'] or None)
+        self.exchange_watcher.add_trade_callback(self.candles.add_trade)
+        self.geocache = geocache.GeoCache(self.config['geo_cache_file'] or None)
+        try:
+            self.tzresolver = tzresolver.TimezoneResolver()
+        except ImportError as e:
+            log.warn("Looking up all !time locations with Google: %s" % (e))
+            self.tzresolver = None
+
+        # commands are methods marked with @command, plus any from plugin modules
+        self.router = CommandRouter(self.config['command_prefix'], self.config['response_cache_ttl'])
+        self.router.register_object(self)
+        for plugin in self.config['command_plugins']:
+            # an empty setting reads as ['']
+            if plugin:
+                self.router.load_plugin(plugin, self)
 
     def set_name(self, nickname):
         self.name = nickname
 
-    def dispatch(self, msg, user=''):
+    def dispatch(self, msg, user='', channel=None):
         """ Handle a received message, dispatching it to the appropriate command responder.
         Parameters:
             msg - received message (string)
             user - who sent the message
+            channel - channel the message was sent in, or None for private messages
         Return value: response message (string/deferred)"""
-        # dispatching inspired by https://twistedmatrix.com/documents/current/core/examples/stdiodemo.py
-        msg = msg.strip()
-
-        # all commands are delegated to methods starting with cmd_
-        if msg.startswith(self.config['command_prefix']):
-            args = msg.split()
-            # remove the prefix
-            args[0] = args[0][len(self.config['command_prefix']):]
-
-            cmd = args[0]
-            args = args[1:]
-
-            try:
-                cmd_method = getattr(self, 'cmd_' + cmd)
-            except AttributeError as e:
-                log.warn('Invalid command {0} used by {1} with arguments {2}'.format(cmd, user, args))
-            else:
-                try:
-                    return cmd_method(user, *args)
-                except TypeError as e:
-                    log.warn('Issue dispatching {0} for {1} (cmd={2}, args={3}'.format(cmd_method, user, cmd, args))
+        return self.router.route(msg, user, channel)
 
+    @command()
     def cmd_donate(self, user=None):
         return "Bitcoin donations accepted at %s." % (self.config['btc_donation_addr'])
 
+    @command(aliases=('commands',), cache=True)
     def cmd_help(self, user=None):
-        return "Commands: {0}time <location>, {0}flair <bear|bull>, {0}flair status [user], {0}flair top".format(
-            self.config['command_prefix'])
-
+        tape_cmds = "{0}volume [period], {0}vwap [period], " if self.tape is not None else ""
+        return ("Commands: {0}time <location>, {0}flair <bear|bull> [percent], {0}flair status [user], "
+                "{0}flair top [count] [page], {0}flair rank [user], {0}flair history [user], "
+                "{0}flair stats [user], " + tape_cmds +
+                "{0}price, {0}change [period]").format(self.config['command_prefix'])
+
+    @command()
+    def cmd_price(self, user=None):
+        if self.candles.last_price is None:
+            return "I haven't seen any trades yet. Please try again later."
+        ret = "Last trade $%.2f" % (self.candles.last_price)
+        bid, ask = self.exchange_watcher.highestbid, self.exchange_watcher.lowestask
+        if bid and ask:
+            ret += ", bid $%.2f, ask $%.2f" % (bid, ask)
+        return ret + "."
+
+    @command(usage="{0}change [period]")
+    def cmd_change(self, user, period='24h'):
+        secs = utils.parse_duration(period)
+        if secs is None:
+            return "Invalid period '%s', try e.g. 1h, 24h or 7d." % (period)
+        summary = self.candles.summary(secs, utils.now_in_utc_secs())
+        if summary is None:
+            return "I don't have price history for the last %s." % (period)
+        log.info("Returning %s price change for %s" % (period, user))
+        change = (summary['close'] / summary['open'] * 100) - 100
+        return "%s change: %s%.2f%% ($%.2f to $%.2f), high $%.2f, low $%.2f, volume %s BTC" % \
+               (period, '+' if change > 0 else '', change, summary['open'], summary['close'],
+                summary['high'], summary['low'], utils.truncatefloat(summary['volume']))
+
+    def _tape_period(self, period):
+        """Parse a period for trade tape commands, returning (start_ms, end_ms) or None."""
+        secs = utils.parse_duration(period)
+        if secs is None:
+            return None
+        now = utils.now_in_utc_ms()
+        return now - secs*1000, now
+
+    @command(usage="{0}volume [period]")
+    def cmd_volume(self, user, period='1h'):
+        if self.tape is None:
+            return "The trade tape is disabled, so I don't have individual trades to go on."
+        span = self._tape_period(period)
+        if span is None:
+            return "Invalid period '%s', try e.g. 30m, 1h or 1d." % (period)
+        log.info("Returning %s volume for %s" % (period, user))
+        return "Volume over the last %s: %s BTC" % (period, utils.truncatefloat(self.tape.volume(*span)))
+
+    @command(usage="{0}vwap [period]")
+    def cmd_vwap(self, user, period='1h'):
+        if self.tape is None:
+            return "The trade tape is disabled, so I don't have individual trades to go on."
+        span = self._tape_period(period)
+        if span is None:
+            return "Invalid period '%s', try e.g. 30m, 1h or 1d." % (period)
+        log.info("Returning %s VWAP for %s" % (period, user))
+        vwap = self.tape.vwap(*span)
+        if vwap is None:
+            return "No trades in the last %s." % (period)
+        return "VWAP over the last %s: $%.2f" % (period, vwap)
+
+    @command(aliases=('tz',))
     @defer.inlineCallbacks
     def cmd_time(self, user, *msg):
         #results = re.search('!time\s+(.+?)\s*$', msg)
@@ -71,8 +136,11 @@ class BotResponder(object):
             defer.returnValue(None)
         log.info("Looking up current time in '%s' for %s" % (location, user))
 
-        localized = yield utils.lookup_localized_time(location, datetime.datetime.utcnow(),
-                                                      self.config['google_api_key'])
+        now = datetime.datetime.utcnow()
+        localized = self.tzresolver.localize(location, now) if self.tzresolver is not None else None
+        if localized is None:
+            localized = yield utils.lookup_localized_time(location, now, self.config['google_api_key'],
+                                                          self.geocache)
         if localized:
             defer.returnValue("The time in %s is %s" %
                               (localized['location'],
@@ -80,15 +148,44 @@ class BotResponder(object):
         else:
             defer.returnValue("Invalid location.")
 
-    def cmd_flair(self, user, *msg):
+    def flair_league(self, channel):
+        """Flair league played in a channel: the channel itself if flair_leagues is on, else the global league,
+        and in either case separate for each flair_season."""
+        league = ''
+        if self.config['flair_leagues'] and channel:
+            league = channel.lower()
+        if self.config['flair_season']:
+            league += ':' + self.config['flair_season'].replace(' ', '')
+        return league
+
+    def flair_cache_key(self, user, *msg, **kwargs):
+        """What a flair command's response depends on besides its arguments: the league's state, and who asked
+        if it's about them. None for flair changes, which must always run."""
+        if msg and msg[0] in ('bull', 'bear'):
+            return None
+        league = self.flair_league(kwargs.get('channel'))
+        version = self.flair.state_version(league)
+        if version is None:
+            return None
+        about_user = len(msg) == 0 or (len(msg) == 1 and msg[0] in ('status', 'rank', 'history', 'stats'))
+        return version, user.lower() if about_user else None
+
+    @command(takes_channel=True, cache=True, cache_key='flair_cache_key')
+    def cmd_flair(self, user, *msg, **kwargs):
+        league = self.flair_league(kwargs.get('channel'))
         if len(msg) == 0:
             log.info("No flair subcommand specified, so returning %s's flair stats." % (user))
-            return self.flair.status(user)
+            return self.flair.status(user, league)
 
         cmd = msg[0]
         if cmd == 'bull' or cmd == 'bear':
-            log.info("Attempting to change %s's flair to %s" % (user, cmd))
-            return self.flair.change(user, cmd)
+            # !flair <bull|bear> [percent]
+            try:
+                percent = int(msg[1].rstrip('%')) if len(msg) > 1 else 100
+            except ValueError:
+                return "Usage: {0}flair <bear|bull> [percent]".format(self.config['command_prefix'])
+            log.info("Attempting to change %s's flair to %s (%d%%) in league '%s'" % (user, cmd, percent, league))
+            return self.flair.change(user, cmd, league, percent)
         elif cmd == 'status':
             target = user
             if len(msg) > 1:
@@ -96,7 +193,27 @@ class BotResponder(object):
                 log.info("Returning %s's flair stats for %s" % (target, user))
             else:
                 log.info("Returning %s's flair stats" % (user))
-            return self.flair.status(target)
+            return self.flair.status(target, league)
         elif cmd == 'top':
+            # !flair top [count] [page]
+            try:
+                count = int(msg[1]) if len(msg) > 1 else 3
+                page = int(msg[2]) if len(msg) > 2 else 1
+            except ValueError:
+                return "Usage: {0}flair top [count] [page]".format(self.config['command_prefix'])
             log.info("Returning top flair user statistics for %s" % (user))
-            return self.flair.top()
\ No newline at end of file
+            return self.flair.top(count, page, league)
+        elif cmd == 'rank':
+            target = user
+            if len(msg) > 1:
+                target = msg[1]
+            log.info("Returning %s's flair rank for %s" % (target, user))
+            return self.flair.rank(target, league)
+        elif cmd == 'history' or cmd == 'stats':
+            target = user
+            if len(msg) > 1:
+                target = msg[1]
+            log.info("Returning %s's flair %s for %s" % (target, cmd, user))
+            if cmd == 'history':
+                return self.flair.history(target, league=league)
+            return self.flair.show_stats(target, league)
\ No newline at end of file
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+import cPickle as pickle
+import logging
+import os
+from array import array
+
+from twisted.internet import reactor, task, threads
+
+log = logging.getLogger(__name__)
+
+
+class CandleSeries(object):
+    """Ring of OHLCV candles of one interval, stored in parallel arrays.
+
+    A candle's slot is derived from its start time, so looking up the candle covering any
+    time within the series' span is O(1)."""
+    fields = ('starts', 'opens', 'highs', 'lows', 'closes', 'volumes')
+
+    def __init__(self, interval, length):
+        """interval: candle length in seconds. length: number of candles kept."""
+        self.interval = interval
+        self.length = length
+        for field in self.fields:
+            setattr(self, field, array('d', [0.0]) * length)
+        # -1 marks slots that have never held a candle
+        self.starts = array('d', [-1.0]) * length
+
+    @property
+    def span(self):
+        return self.interval * self.length
+
+    def start_of(self, timestamp):
+        return timestamp - timestamp % self.interval
+
+    def slot(self, timestamp):
+        """Index of the slot for the candle covering timestamp (in seconds)."""
+        return int(timestamp // self.interval) % self.length
+
+    def get(self, timestamp):
+        """Return (start, open, high, low, close, volume) for the candle covering timestamp, or None."""
+        i = self.slot(timestamp)
+        if self.starts[i] != self.start_of(timestamp):
+            return None
+        return tuple(getattr(self, field)[i] for field in self.fields)
+
+    def merge(self, start, o, h, l, c, v):
+        """Fold OHLCV data starting at `start` into the candle covering it."""
+        i = self.slot(start)
+        cstart = self.start_of(start)
+        if self.starts[i] != cstart:
+            self.starts[i] = cstart
+            self.opens[i] = o
+            self.highs[i] = h
+            self.lows[i] = l
+            self.volumes[i] = v
+        else:
+            self.highs[i] = max(self.highs[i], h)
+            self.lows[i] = min(self.lows[i], l)
+            self.volumes[i] += v
+        self.closes[i] = c
+
+    def state(self):
+        return dict((field, getattr(self, field).tostring()) for field in self.fields)
+
+    def restore(self, state):
+        for field in self.fields:
+            values = array('d')
+            values.fromstring(state[field])
+            if len(values) == self.length:
+                setattr(self, field, values)
+
+
+class CandleStore(object):
+    """OHLCV candles at several intervals, built incrementally from the trade stream.
+
+    Trades only ever update the current 1 minute candle. When it closes, it is rolled up into the
+    coarser series, so reading a coarser candle that is still open means merging it with the open
+    minute. Price questions are answered from candles, never from raw trades."""
+    # (interval in seconds, number of candles): a day of 1m, a week of 5m, a month of 1h, a year of 1d
+    series_spec = ((60, 24*60), (5*60, 7*24*12), (60*60, 30*24), (24*60*60, 365))
+
+    def __init__(self, path=None, checkpoint_interval=60):
+        self.path = path
+        self.series = [CandleSeries(interval, length) for interval, length in self.series_spec]
+        self.minutes = self.series[0]
+        self.last_price = None
+        self.last_time = None
+        # start time of the 1 minute candle not yet rolled up
+        self._open_minute = None
+
+        self.checkpointer = None
+        if self.path:
+            self.load()
+            self.checkpointer = task.LoopingCall(self.checkpoint)
+            self.checkpointer.start(checkpoint_interval, now=False)
+            reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        if self.checkpointer is not None and self.checkpointer.running:
+            self.checkpointer.stop()
+        if self.path:
+            self._write(self._dump())
+
+    def add_trade(self, trade):
+        """Trade callback, see ExchangeWatcher.add_trade_callback."""
+        timestamp = trade.timestamp / 1000.0
+        price = float(trade.price)
+        minute = self.minutes.start_of(timestamp)
+        if self._open_minute is not None and minute > self._open_minute:
+            self._roll_up()
+        if self._open_minute is None or minute >= self._open_minute:
+            self._open_minute = minute
+        self.minutes.merge(timestamp, price, price, price, price, float(trade.amount))
+        self.last_price = price
+        self.last_time = timestamp
+
+    def _roll_up(self):
+        candle = self.minutes.get(self._open_minute)
+        if candle is not None:
+            for series in self.series[1:]:
+                series.merge(*candle)
+        self._open_minute = None
+
+    def candle(self, interval, timestamp):
+        """Return (start, open, high, low, close, volume) for the candle of `interval` seconds covering
+        timestamp, including the minute that hasn't been rolled up yet. None if there is no data."""
+        series = self._series_for_interval(interval)
+        candle = series.get(timestamp)
+        if series is self.minutes or self._open_minute is None or \
+                series.start_of(self._open_minute) != series.start_of(timestamp):
+            return candle
+        minute = self.minutes.get(self._open_minute)
+        if candle is None:
+            return (series.start_of(timestamp),) + minute[1:]
+        start, o, h, l, c, v = candle
+        return start, o, max(h, minute[2]), min(l, minute[3]), minute[4], v + minute[5]
+
+    def _series_for_interval(self, interval):
+        for series in self.series:
+            if series.interval == interval:
+                return series
+        raise ValueError("No candles with an interval of %s seconds." % (interval))
+
+    def _series_for_span(self, secs):
+        """Finest series that covers `secs` seconds into the past."""
+        for series in self.series:
+            if series.span > secs + series.interval:
+                return series
+
+    def price_at(self, timestamp):
+        """Close of the most recent candle at or before timestamp, at the finest resolution available."""
+        series = self._series_for_span(self.last_time - timestamp if self.last_time else 0)
+        if series is None:
+            return None
+        # walk back over candles with no trades
+        t = timestamp
+        for _ in xrange(series.length):
+            candle = self.candle(series.interval, t)
+            if candle is not None:
+                return candle[4]
+            t -= series.interval
+        return None
+
+    def summary(self, secs, now):
+        """Dict with 'open', 'close', 'high', 'low', 'volume' over the last `secs` seconds, or None.
+        Uses the coarsest candles that still split the period into at least 12, so at most a few
+        dozen to a couple hundred candles are read. Candles overlapping the start of the period aren't
+        counted; up to the first coarse candle starting within it, the finest candles still kept are read."""
+        series = None
+        for candidate in self.series:
+            if candidate.interval * 12 <= secs and candidate.span > secs + candidate.interval:
+                series = candidate
+        if series is None:
+            series = self._series_for_span(secs)
+        if series is None or self.last_price is None:
+            return None
+        start = now - secs
+        finer = self.series[:self.series.index(series) + 1]
+        high = low = first_open = None
+        volume = 0.0
+        t = self.minutes.start_of(start)
+        if t < start:
+            t += self.minutes.interval
+        while t <= now:
+            # coarsest candle starting at t that's still kept, or else the finest kept one covering t
+            kept = [candidate for candidate in finer if candidate.span > now - t] or [series]
+            step = kept[0]
+            for candidate in reversed(kept):
+                if t % candidate.interval == 0:
+                    step = candidate
+                    break
+            candle = self.candle(step.interval, t)
+            if candle is not None:
+                if first_open is None:
+                    first_open = candle[1]
+                high = candle[2] if high is None else max(high, candle[2])
+                low = candle[3] if low is None else min(low, candle[3])
+                volume += candle[5]
+            t = step.start_of(t) + step.interval
+        if high is None:
+            return None
+        # if there's no history from before the period, start from the first trade in it
+        opened = self.price_at(start)
+        if opened is None:
+            opened = first_open
+        return {'open': opened, 'close': self.last_price, 'high': high, 'low': low, 'volume': volume}
+
+    def _dump(self):
+        return pickle.dumps({'series': [(s.interval, s.length, s.state()) for s in self.series],
+                             'last_price': self.last_price, 'last_time': self.last_time,
+                             'open_minute': self._open_minute}, pickle.HIGHEST_PROTOCOL)
+
+    def _write(self, data):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp, self.path)
+
+    def checkpoint(self):
+        """Write candles to disk from a thread. Returns a Deferred."""
+        d = threads.deferToThread(self._write, self._dump())
+        d.addErrback(lambda failure: log.error("Could not checkpoint candles to %s: %s" %
+                                               (self.path, failure.getErrorMessage())))
+        return d
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                state = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError) as e:
+            log.error("Could not load candles from %s: %s" % (self.path, e))
+            return
+        by_spec = dict(((interval, length), s) for interval, length, s in state['series'])
+        for series in self.series:
+            if (series.interval, series.length) in by_spec:
+                series.restore(by_spec[(series.interval, series.length)])
+        self.last_price = state['last_price']
+        self.last_time = state['last_time']
+        self._open_minute = state['open_minute']
+        log.info("Loaded candles from %s" % (self.path))
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+import importlib
+import inspect
+import logging
+import time
+
+from twisted.internet import defer
+
+from twobitbot.utils.geocache import LRUCache
+
+log = logging.getLogger(__name__)
+
+
+def command(name=None, aliases=(), usage=None, takes_channel=False, cache=False, cache_key=None):
+    """Mark a function or method as a chat command, to be found by CommandRouter.register_object.
+
+    It's called with the user who sent the command and the words after it, and with a `channel` keyword
+    argument (None in private messages) if takes_channel. name defaults to the function name without any
+    'cmd_' prefix. usage, if given, is formatted with the command prefix and replied when the command is
+    given the wrong number of arguments.
+
+    If cache, responses are reused for identical commands for a short while, see ResponseCache. cache_key
+    is called like the command and returns anything else its response depends on, or None if this response
+    must not be reused. It can be given as the name of a method of the object being registered."""
+    def decorate(func):
+        func.command = {'name': name or func.__name__.replace('cmd_', '', 1), 'aliases': tuple(aliases),
+                        'usage': usage, 'takes_channel': takes_channel, 'cache': cache, 'cache_key': cache_key}
+        return func
+    return decorate
+
+
+class Command(object):
+    """A registered command, with how many words it accepts worked out once from its handler's signature."""
+
+    def __init__(self, name, handler, aliases=(), usage=None, takes_channel=False, cache=False, cache_key=None):
+        self.name = name
+        self.handler = handler
+        self.aliases = aliases
+        self.usage = usage
+        self.takes_channel = takes_channel
+        self.cache = cache
+        self.cache_key = cache_key
+        self.min_args, self.max_args = self._arg_range(handler)
+
+    @staticmethod
+    def _arg_range(handler):
+        """(min, max) words a handler accepts after the user, with max None if unlimited."""
+        func = handler.__func__ if inspect.ismethod(handler) else handler
+        try:
+            spec = inspect.getargspec(func)
+        except TypeError:
+            return 0, None
+        args = spec.args[1:] if inspect.ismethod(handler) else spec.args
+        # the first remaining argument is the user
+        words = max(len(args) - 1, 0)
+        optional = min(len(spec.defaults or ()), words)
+        return words - optional, None if spec.varargs else words
+
+
+class ResponseCache(object):
+    """Responses to recent commands, each reused for `ttl` seconds.
+
+    Keys include whatever versions of state a response depends on, so a response is never reused once that
+    state changes, and the TTL only bounds how stale anything else in it (like 'for 5 mins') can get."""
+
+    def __init__(self, ttl, size=1000, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        # key -> (expiry time, response)
+        self.entries = LRUCache(size)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, response = entry
+        if self.clock() >= expires:
+            self.entries.discard(key)
+            return None
+        return response
+
+    def put(self, key, response):
+        self.entries.put(key, (self.clock() + self.ttl, response))
+
+
+class CommandRouter(object):
+    """Routes chat messages to commands, looked up by name or alias in a table built at startup.
+    Responses of commands registered with cache are reused for cache_ttl seconds, 0 disabling this."""
+
+    def __init__(self, prefix='!', cache_ttl=0):
+        self.prefix = prefix
+        # name or alias -> Command
+        self.commands = dict()
+        self.cache = ResponseCache(cache_ttl) if cache_ttl else None
+
+    def __contains__(self, name):
+        return name in self.commands
+
+    def register(self, cmd):
+        for name in (cmd.name,) + tuple(cmd.aliases):
+            if name in self.commands:
+                raise ValueError("Command name %s%s is already taken by %s" %
+                                 (self.prefix, name, self.commands[name].name))
+        for name in (cmd.name,) + tuple(cmd.aliases):
+            self.commands[name] = cmd
+
+    def register_object(self, obj):
+        """Register every method of obj marked with @command."""
+        for attr in dir(obj):
+            handler = getattr(obj, attr)
+            spec = getattr(handler, 'command', None)
+            if callable(handler) and isinstance(spec, dict):
+                spec = dict(spec)
+                if isinstance(spec['cache_key'], basestring):
+                    spec['cache_key'] = getattr(obj, spec['cache_key'])
+                self.register(Command(handler=handler, **spec))
+
+    def load_plugin(self, module_name, *args):
+        """Import a module of commands, which registers them from a function setup(router, *args)."""
+        module = importlib.import_module(module_name)
+        module.setup(self, *args)
+        log.info("Loaded command plugin %s" % (module_name))
+
+    def route(self, msg, user='', channel=None):
+        """Run the command in msg, returning its response (string/deferred), or None if msg isn't a command."""
+        msg = msg.strip()
+        if not msg.startswith(self.prefix):
+            return None
+        args = msg[len(self.prefix):].split()
+        if not args:
+            return None
+        cmd = self.commands.get(args[0])
+        if cmd is None:
+            log.warn('Invalid command {0} used by {1} with arguments {2}'.format(args[0], user, args[1:]))
+            return None
+        args = args[1:]
+        if len(args) < cmd.min_args or (cmd.max_args is not None and len(args) > cmd.max_args):
+            log.warn('Wrong number of arguments to {0} from {1}: {2}'.format(cmd.name, user, args))
+            if cmd.usage:
+                return "Usage: " + cmd.usage.format(self.prefix)
+            return None
+
+        key = self._cache_key(cmd, user, args, channel)
+        if key is not None:
+            response = self.cache.get(key)
+            if response is not None:
+                return response
+        if cmd.takes_channel:
+            response = cmd.handler(user, *args, channel=channel)
+        else:
+            response = cmd.handler(user, *args)
+        if key is not None:
+            if isinstance(response, defer.Deferred):
+                response.addCallback(self._cache_response, key)
+            else:
+                self._cache_response(response, key)
+        return response
+
+    def _cache_key(self, cmd, user, args, channel):
+        """Key to cache a command's response under, or None if it isn't to be cached."""
+        if self.cache is None or not cmd.cache:
+            return None
+        extra = None
+        if cmd.cache_key is not None:
+            if cmd.takes_channel:
+                extra = cmd.cache_key(user, *args, channel=channel)
+            else:
+                extra = cmd.cache_key(user, *args)
+            if extra is None:
+                return None
+        return cmd.name, tuple(args), channel if cmd.takes_channel else None, extra
+
+    def _cache_response(self, response, key):
+        if isinstance(response, basestring):
+            self.cache.put(key, response)
+        return response
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class ExchangeWatcher(object):
+    """Interface for objects that follow an exchange's market data and send alerts about it.
+
+    Subclasses provide highestbid/lowestask (None if unknown or stale), call _send_alert
+    with alert messages, and _send_trade with a trades.Trade for every trade seen.
+    Anything that only needs prices, like Flair, should depend on this interface."""
+    name = None
+
+    def __init__(self):
+        self.alert_cbs = list()
+        self.trade_cbs = list()
+
+    @property
+    def highestbid(self):
+        raise NotImplementedError
+
+    @property
+    def lowestask(self):
+        raise NotImplementedError
+
+    def add_alert_callback(self, callback):
+        self.alert_cbs.append(callback)
+
+    def remove_alert_callback(self, callback):
+        if callback in self.alert_cbs:
+            self.alert_cbs.remove(callback)
+
+    def _send_alert(self, msg):
+        for cb in self.alert_cbs:
+            cb(msg)
+
+    def add_trade_callback(self, callback):
+        """callback is called with a trades.Trade, timestamped in UTC ms, for each trade."""
+        self.trade_cbs.append(callback)
+
+    def _send_trade(self, trade):
+        for cb in self.trade_cbs:
+            cb(trade)
+
+
+class WatcherRegistry(ExchangeWatcher):
+    """Runs several ExchangeWatchers side by side and presents them as one.
+
+    Alerts and trades from every watcher are forwarded to the registry's callbacks, and highestbid/lowestask
+    are the best prices across all venues with fresh data. Nothing here polls; consolidated prices
+    are read from the watchers on demand."""
+    name = 'all'
+
+    def __init__(self, watchers=()):
+        super(WatcherRegistry, self).__init__()
+        self.watchers = dict()
+        for watcher in watchers:
+            self.add(watcher)
+
+    def add(self, watcher):
+        if not isinstance(watcher, ExchangeWatcher):
+            raise ValueError("Registry can only hold ExchangeWatchers.")
+        if watcher.name in self.watchers:
+            raise ValueError("An exchange watcher named %s is already registered." % (watcher.name))
+        self.watchers[watcher.name] = watcher
+        watcher.add_alert_callback(self._send_alert)
+        watcher.add_trade_callback(self._send_trade)
+
+    def get(self, name):
+        return self.watchers.get(name)
+
+    def best_bid(self):
+        """Highest bid across venues as a tuple (price, venue name), or None."""
+        best = None
+        for name, watcher in self.watchers.iteritems():
+            bid = watcher.highestbid
+            if bid is not None and (best is None or bid > best[0]):
+                best = (bid, name)
+        return best
+
+    def best_ask(self):
+        """Lowest ask across venues as a tuple (price, venue name), or None."""
+        best = None
+        for name, watcher in self.watchers.iteritems():
+            ask = watcher.lowestask
+            if ask is not None and (best is None or ask < best[0]):
+                best = (ask, name)
+        return best
+
+    @property
+    def highestbid(self):
+        best = self.best_bid()
+        if best:
+            return best[0]
+
+    @property
+    def lowestask(self):
+        best = self.best_ask()
+        if best:
+            return best[0]
@@ -2,62 +2,152 @@
 
 import logging
 import datetime
-from decimal import Decimal
-from collections import namedtuple
 
 from twisted.internet import defer, reactor
 from twisted.application import service
-from twisted.enterprise import adbapi
 
 from twobitbot import utils
-from twobitbot.utils import ratelimit
+from twobitbot.utils import ratelimit, fixedpoint
+from twobitbot.leaderboard import Leaderboard
+from twobitbot.marktomarket import MarkToMarket, holds_both_sides
+from twobitbot.flairstore import open_store, FlairRow, FlairStats, NO_STATS, trade_return_bp, add_trade_to_stats
 
 
 log = logging.getLogger(__name__)
 
 # not sure whether to put all this code into a service, or write a thin wrapper service around the Flair class...
 
-# todo change decimal code to use sqlite3 converter and adapter
-# http://stackoverflow.com/questions/6319409/how-to-convert-python-decimal-to-sqlite-numeric
-# todo FlairRow for updating DB, and more transparent Decimal conversion
-
 # todo convert top user list to BTC instead of USD
 
-FlairRow = namedtuple('FlairRow', ['user', 'type', 'price', 'usd_amt', 'btc_amt', 'time'])
+
+class League(object):
+    """One flair game, with its own users, standings and marks. name is lowercase, and '' is the global game."""
+
+    def __init__(self, name, watcher, mark_epsilon=0):
+        self.name = name
+        # latest FlairRow for each user, keyed by lowercased name, so lookups never hit the DB
+        self.latest = dict()
+        self.leaderboard = Leaderboard()
+        # FlairStats for each user with closed positions, keyed by lowercased name
+        self.stats = dict()
+        # every position valued at recent prices, see MarkToMarket
+        self.marks = MarkToMarket(watcher, self.latest, mark_epsilon)
+        # fires once the league's flair is loaded from the store
+        self.loaded = None
+        # number of flair changes seen, so responses about the league can tell when they're out of date
+        self.changes = 0
+
+    def cache(self, row):
+        self.latest[row.user.lower()] = row
+        self.leaderboard.update(row)
+        self.changes += 1
 
 
 class Flair(object):
-    btcpip = Decimal(10000)
-    usdpip = Decimal(100)
+    btcpip = fixedpoint.BTC_PIP
+    usdpip = fixedpoint.USD_PIP
+    # most users shown at once by top
+    top_max = 10
 
-    def __init__(self, exchange_watcher, flair_db, ratelimiter=None):
+    def __init__(self, exchange_watcher, flair_db, ratelimiter=None, flush_delay=0.5, mark_epsilon=0):
         # todo implement better method of doing stuff than passing an exchange_watcher
         self.watcher = exchange_watcher
         self.ratelimiter = ratelimiter or ratelimit.ConstantRateLimiter(delay=3*60)
         self.db_location = flair_db
-
-        self.dbpool = None
+        self.mark_epsilon = mark_epsilon
+
+        # League for each league name, loaded from the store when first used
+        self.leagues = dict()
+        self.loaded = None
+        # flair updates waiting to be written, see _insert_flairupdate
+        self.flush_delay = flush_delay
+        self._pending = list()
+        self._flush_call = None
+        self._flushing = None
+
+        self.store = None
         self.start()
 
         # todo possibly remove shutdown call? check if this and check_same_thread are necessary...
         reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
 
     def start(self):
-        self.dbpool = adbapi.ConnectionPool('sqlite3', self.db_location, check_same_thread=False)
-        if not self.dbpool:
-            raise IOError("Could not load flair DB {0}".format(self.db_location))
+        self.store = open_store(self.db_location)
+        self.store.add_change_observer(self._changed_elsewhere)
+        self.loaded = self.store.start()
+        self.leagues = dict()
+
+    def league(self, name=''):
+        """League by name, which starts loading the first time it's asked for."""
+        league = self.leagues.get(name)
+        if league is None:
+            league = self.leagues[name] = League(name, self.watcher, self.mark_epsilon)
+            league.loaded = self._load_league(league)
+        return league
 
-        create_table = """CREATE TABLE IF NOT EXISTS ircflair (id INTEGER PRIMARY KEY,
-                      user TEXT COLLATE NOCASE, flairstatus TEXT, flairprice INTEGER, usd_amount INTEGER,
-                      btc_amount INTEGER, timestamp INTEGER)"""
-        self.dbpool.runQuery(create_table)
+    @defer.inlineCallbacks
+    def _load_league(self, league):
+        yield self.loaded
+        rows = yield self.store.load_current(league.name)
+        for row in rows:
+            league.cache(self._to_flairrow(row))
+        rows = yield self.store.load_stats(league.name)
+        league.stats.update((row[0].lower(), FlairStats(*row[1:])) for row in rows)
+        log.info("Loaded flair for %d users in league '%s'" % (len(league.latest), league.name))
+
+    def state_version(self, league=''):
+        """Value that changes whenever anything shown about a league might: a flair changing, or prices moving
+        enough to revalue positions. None while the league isn't loaded. Cheap, as nothing is revalued."""
+        game = self.leagues.get(league)
+        if game is None or not game.loaded.called:
+            return None
+        return game.changes, game.marks.price_key()
+
+    @staticmethod
+    def _to_flairrow(row):
+        # in order: user, type, price, usd_amt, btc_amt, time, other_price
+        return FlairRow(row[0], row[1], int(row[2]), int(row[3]), int(row[4]), int(row[5]), int(row[6]))
 
+    @defer.inlineCallbacks
+    def _changed_elsewhere(self, league, user):
+        """Reload a user whose flair another bot sharing the store has changed."""
+        league = self.leagues.get(league)
+        if league is None:
+            # not loaded here yet, so it'll be up to date when it is
+            return
+        yield league.loaded
+        current, stats = yield self.store.load_user(league.name, user)
+        # our own queued updates for the user are newer than anything in the store
+        if any(name == league.name and row[0].lower() == user for name, row, _ in self._pending):
+            return
+        if current is not None:
+            league.cache(self._to_flairrow(current))
+        if stats is not None:
+            league.stats[user] = FlairStats(*stats[1:])
+
+    @defer.inlineCallbacks
     def stop(self):
-        if self.dbpool:
-            self.dbpool.finalClose()
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        if self._flushing is not None:
+            yield self._flushing
+        if self._pending:
+            yield self.flush()
+        if self.store and self.store.running:
+            self.store.close()
+
+    @staticmethod
+    def _balance_str(row):
+        if row.btc_amt and row.usd_amt:
+            return "%s BTC and $%s" % (fixedpoint.format_btc(row.btc_amt), fixedpoint.format_cents(row.usd_amt))
+        elif row.btc_amt:
+            return "%s BTC" % (fixedpoint.format_btc(row.btc_amt))
+        return "$%s" % (fixedpoint.format_cents(row.usd_amt))
 
     @defer.inlineCallbacks
-    def change(self, user, cmd):
+    def change(self, user, cmd, league='', percent=100):
+        """Move `percent` of a user's USD into BTC (bull) or of their BTC into USD (bear)."""
         price = 0
 
         if not self.watcher.lowestask or not self.watcher.highestbid:
@@ -72,124 +162,231 @@ class Flair(object):
             log.debug("Invalid flair change command: '%s' by %s" % (cmd, user))
             defer.returnValue(None)
 
+        if not 0 < percent <= 100:
+            defer.returnValue("%s, you can only move between 1%% and 100%% of your balance." % (user))
+
         if self.ratelimiter.is_limited(user):
             defer.returnValue("I'm sorry %s, I'm afraid I can't do that. Wait a few minutes first." % (user))
 
-        old = yield self.check_last(user)
-        new = {'user': user, 'type': cmd, 'price': price*Flair.usdpip, 'usd_amt': 0, 'btc_amt': 0}
+        game = self.league(league)
+        old = yield self.check_last(user, league)
+        price_cents = fixedpoint.to_cents(price)
+        # entry price of what is held on each side, 0 for none
         if not old:
-            # user hasn't set flair before
-            log.debug("Initializing flair %s for %s at %.2f" % (cmd, user, price))
-            if cmd == 'bull':
-                new['btc_amt'] = 1*Flair.btcpip
-            elif cmd == 'bear':
-                new['usd_amt'] = price*Flair.usdpip
-            self._insert_flairupdate(new)
-            defer.returnValue("%s, welcome to the flair game! You are now %s from $%.2f." % (user, cmd, price))
-        elif cmd != old.type:
-            # valid command to change flair, user already has it set
-            amt_str = ''
-            if cmd == 'bull':
-                log.debug("Updating flair to %s for %s (who has $%s), old price %.2f and new price %.2f" %
-                         (cmd, user, old.usd_amt/Flair.usdpip, old.price/Flair.usdpip, price))
-                new['btc_amt'] = old.usd_amt / price * Flair.usdpip
-                amt_str = "%.4f BTC" % (new['btc_amt']/Flair.btcpip)
-            elif cmd == 'bear':
-                log.debug("Updating flair to %s for %s (who has %.4f BTC), old price %.2f and new price %.2f" %
-                         (cmd, user, old.btc_amt/Flair.btcpip, old.price/Flair.usdpip, price))
-                new['usd_amt'] = price * old.btc_amt * (Flair.usdpip / Flair.btcpip)
-                amt_str = "$%.2f" % (new['usd_amt'] / Flair.usdpip)
-            self._insert_flairupdate(new)
-            self.ratelimiter.user_event_now(user)
-            defer.returnValue("%s, you are now %s from $%.2f with %s." % (user, cmd, price, amt_str))
+            # new users start out with the equivalent of 1 BTC, in whatever they are moving out of
+            usd, btc = (price_cents, 0) if cmd == 'bull' else (0, 1*Flair.btcpip)
+            entries = {'bull': 0, 'bear': 0}
+        else:
+            usd, btc = old.usd_amt, old.btc_amt
+            entries = {old.type: old.price, self._other_type(old.type): old.other_price}
+        other = self._other_type(cmd)
+        # what the holdings cost, with anything of no entry price (the starting balance) at today's price
+        book = usd + fixedpoint.btc_to_usd(btc, entries['bull'] or price_cents)
+
+        # moved is what leaves the balance being moved out of, in its own units, and bought is what it buys
+        if cmd == 'bull':
+            balance = usd
+            moved = fixedpoint.div_round(usd * percent, 100, fixedpoint.ROUND_DOWN)
+            bought = fixedpoint.usd_to_btc(moved, price_cents)
+            entry = self._entry_price(btc, entries['bull'], bought, price_cents)
+            moved_cost = moved
+            usd, btc = usd - moved, btc + bought
+            left = usd
         else:
+            balance = btc
+            moved = fixedpoint.div_round(btc * percent, 100, fixedpoint.ROUND_DOWN)
+            bought = fixedpoint.btc_to_usd(moved, price_cents)
+            held = fixedpoint.usd_to_btc(usd, entries['bear']) if entries['bear'] else 0
+            entry = self._entry_price(held, entries['bear'], moved, price_cents)
+            moved_cost = fixedpoint.btc_to_usd(moved, entries['bull'])
+            usd, btc = usd + bought, btc - moved
+            left = btc
+        if old and not balance:
             # user tried to change flair to current value
             defer.returnValue("%s, you are already a %s." % (user, cmd))
-
-    def _insert_flairupdate(self, rec):
-        for k in ('price', 'usd_amt', 'btc_amt'):
-            rec[k] = int(rec[k])
-        return self.dbpool.runQuery("""INSERT INTO ircflair(user, flairstatus, flairprice,
-                                usd_amount, btc_amount, timestamp)
-                                VALUES(?, ?, ?, ?, ?, ?)""",
-                                    (rec['user'], rec['type'], rec['price'], rec['usd_amt'],
-                                     rec['btc_amt'], utils.now_in_utc_secs()))
-
-    def _check(self, user):
-        return self.dbpool.runQuery("""SELECT user, flairstatus, flairprice, usd_amount, btc_amount, timestamp
-                                    FROM ircflair WHERE user = ? ORDER BY timestamp DESC""", (user,))
+        if not bought:
+            defer.returnValue("%s, %d%% of your balance is too small to move." % (user, percent))
+
+        trade = None
+        if entries[other]:
+            # all or part of what was bought at entries[other] is closed, so it goes into the user's stats
+            trade = (trade_return_bp(other, entries[other], price_cents), float(moved_cost) / book)
+        new = {'user': user, 'type': cmd, 'price': entry, 'usd_amt': usd, 'btc_amt': btc,
+               'other_price': entries[other] if left else 0}
+        self._insert_flairupdate(game, new, trade)
+        if not old:
+            # user hasn't set flair before
+            log.debug("Initializing flair %s for %s at %.2f in league '%s'" % (cmd, user, price, game.name))
+            ret = "%s, welcome to the flair game! You are now %s from $%.2f" % (user, cmd, price)
+            if percent != 100:
+                ret += " with %s" % (self._balance_str(game.latest[user.lower()]))
+            defer.returnValue(ret + ".")
+        log.debug("Updating flair to %s for %s (who had %s), old price %s and new price %.2f" %
+                  (cmd, user, self._balance_str(old), fixedpoint.format_cents(old.price), price))
+        self.ratelimiter.user_event_now(user)
+        defer.returnValue("%s, you are now %s from $%s with %s." %
+                          (user, cmd, fixedpoint.format_cents(entry), self._balance_str(game.latest[user.lower()])))
+
+    @staticmethod
+    def _other_type(flair_type):
+        return 'bear' if flair_type == 'bull' else 'bull'
+
+    @staticmethod
+    def _entry_price(held, held_price, added, price):
+        """Entry price of a side holding `held` BTC worth (0 for none) bought (bull) or sold (bear) at held_price,
+        once `added` more is at price: the average price of it all, weighted by BTC."""
+        if not held or not held_price:
+            return price
+        return fixedpoint.div_round(held * held_price + added * price, held + added)
+
+    def _insert_flairupdate(self, league, rec, trade=None):
+        """Update the cache right away, and queue the update to be written to the DB in a batch.
+        trade is (return in basis points, part of the holdings closed) if the update closes anything."""
+        row = (rec['user'], rec['type'], rec['price'], rec['usd_amt'], rec['btc_amt'], utils.now_in_utc_secs(),
+               rec['other_price'])
+        stats_row = None
+        if trade is not None:
+            # the user closed all or part of what they held, so fold it into their stats
+            stats = add_trade_to_stats(league.stats.get(rec['user'].lower(), NO_STATS), *trade)
+            league.stats[rec['user'].lower()] = stats
+            stats_row = (rec['user'],) + tuple(stats)
+        league.cache(self._to_flairrow(row))
+        self._pending.append((league.name, row, stats_row))
+        if self._flush_call is None and self._flushing is None:
+            self._flush_call = reactor.callLater(self.flush_delay, self.flush)
+
+    def flush(self):
+        """Write all queued flair updates in one transaction. Returns a Deferred."""
+        # flush may be called early, e.g. by history, so don't leave the scheduled flush behind
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        batch, self._pending = self._pending, list()
+        self._flushing = self.store.write_batch(batch)
+        self._flushing.addErrback(self._flush_failed, batch)
+        self._flushing.addBoth(self._flushed)
+        return self._flushing
+
+    def _flush_failed(self, failure, batch):
+        log.error("Could not write %d flair updates, will retry: %s" % (len(batch), failure.getErrorMessage()))
+        self._pending = batch + self._pending
+
+    def _flushed(self, _):
+        self._flushing = None
+        if self._pending and self.store.running:
+            self._flush_call = reactor.callLater(self.flush_delay, self.flush)
 
     @defer.inlineCallbacks
-    def check_last(self, user):
-        rows = yield self._check(user)
-        if rows:
-            # in order: user, type, price, usd_amt, btc_amt, time
-            # need to convert it so we can make Decimals in-place
-            last = list(rows[0])
-            # convert price, usd_amt, btc_amt to Decimals
-            for k in (2, 3, 4):
-                last[k] = Decimal(last[k])
-            # timestamp to int
-            last[5] = int(last[5])
-
-            data = FlairRow(*last)
-            defer.returnValue(data)
-        else:
-            raise ValueError
+    def check_last(self, user, league=''):
+        """Latest FlairRow for user, or None if they haven't joined the flair game."""
+        game = self.league(league)
+        yield game.loaded
+        defer.returnValue(game.latest.get(user.lower()))
 
     @defer.inlineCallbacks
-    def top(self):
+    def top(self, count=3, page=1, league=''):
+        """Show `count` users from the given page of the standings."""
         if not self.watcher.highestbid:
             defer.returnValue("I have no recent orderbook data. Please try again later.")
             log.debug("Top flair called without current bid/ask set.")
 
-        query = """SELECT user, flairstatus, usd_amount, btc_amount, max(timestamp) from ircflair group by user"""
+        game = self.league(league)
+        yield game.loaded
+
+        count = max(1, min(count, Flair.top_max))
+        offset = (max(page, 1) - 1) * count
+        snapshot = game.marks.current()
+        if len(game.leaderboard) and snapshot:
+            top = game.leaderboard.top(count, snapshot.bid, offset)
+            if not top:
+                defer.returnValue("There are only {0:,} flair users.".format(len(game.leaderboard)))
+            top_strs = ["%s (%s with $%s)" % (row.user, row.type, fixedpoint.format_cents(snapshot.mark(row).value))
+                        for row, _ in top]
+            if offset == 0:
+                header = "Top flair users: "
+            else:
+                header = "Flair users #{0:,}-{1:,}: ".format(offset + 1, offset + len(top))
+            defer.returnValue(header + ', '.join(top_strs))
+
+    @defer.inlineCallbacks
+    def rank(self, user, league=''):
+        game = self.league(league)
+        yield game.loaded
 
-        rows = yield self.dbpool.runQuery(query)
+        prices = game.marks.marked_prices()
+        if prices is None:
+            log.debug("Flair rank called without current bid/ask set.")
+            defer.returnValue("I have no recent orderbook data. Please try again later.")
+        # only the bid is needed to order users, so this doesn't revalue anyone. Using the marks' bid keeps the
+        # leaderboard from re-sorting users holding both BTC and USD on moves smaller than epsilon.
+        rank = game.leaderboard.rank(user, prices[0])
+        if rank is None:
+            defer.returnValue("No flair found for user %s. Join the game with !flair <BEAR|BULL>." % (user))
+        defer.returnValue("{0} is #{1:,} of {2:,} flair users.".format(
+            game.latest[user.lower()].user, rank, len(game.leaderboard)))
 
-        if rows and self.watcher.highestbid:
-            normalized_users = list()
-            bull_usd = self.watcher.highestbid
-            for row in rows:
-                # need to convert it to assign, since it's a tuple
-                row = list(row)
-                row[2] = Decimal(row[2])
-                row[3] = Decimal(row[3])
+    @defer.inlineCallbacks
+    def history(self, user, count=5, league=''):
+        """Show a user's most recent flair changes."""
+        yield self.league(league).loaded
+        # make sure queued changes are in the DB before reading it
+        if self._flushing is not None:
+            yield self._flushing
+        if self._pending:
+            yield self.flush()
+
+        rows = yield self.store.history(league, user, count)
+        if not rows:
+            defer.returnValue("No flair found for user %s. Join the game with !flair <BEAR|BULL>." % (user))
+        now = datetime.datetime.utcnow()
+        changes = list()
+        for _, flairstatus, price, timestamp in rows:
+            ago = utils.format_timedelta(now - datetime.datetime.utcfromtimestamp(timestamp))
+            changes.append("%s at $%s (%s ago)" % (flairstatus, fixedpoint.format_cents(price), ago or "<1 min"))
+        defer.returnValue("%s's recent flair: %s" % (rows[0][0], ', '.join(changes)))
 
-                if row[1] == 'bull':
-                    normalized_users.append((row[0], row[1], (row[3] * bull_usd)/Flair.btcpip))
-                else:
-                    normalized_users.append((row[0], row[1], row[2]/100))
-            top = sorted(normalized_users, key=lambda usr: usr[2], reverse=True)
-            top_strs = ["%s (%s with $%.2f)" % (user[0], user[1], user[2]) for user in top[:3]]
-            defer.returnValue("Top flair users: " + ', '.join(top_strs))
+    @defer.inlineCallbacks
+    def show_stats(self, user, league=''):
+        """Show statistics on a user's closed flair positions."""
+        game = self.league(league)
+        yield game.loaded
+        last = game.latest.get(user.lower())
+        if last is None:
+            defer.returnValue("No flair found for user %s. Join the game with !flair <BEAR|BULL>." % (user))
+        stats = game.stats.get(user.lower(), NO_STATS)
+        if not stats.trades:
+            defer.returnValue("%s hasn't closed a flair position yet." % (last.user))
+        defer.returnValue("%s: %d trade%s, %d%% won, best %+.2f%%, worst %+.2f%%, total P/L %+.2f%%" %
+                          (last.user, stats.trades, utils.plural_string(stats.trades),
+                           stats.wins * 100 // stats.trades, stats.best_bp / 100.0, stats.worst_bp / 100.0,
+                           (stats.growth - 1) * 100))
 
     @defer.inlineCallbacks
-    def status(self, user):
+    def status(self, user, league=''):
         if not self.watcher.lowestask or not self.watcher.highestbid:
             defer.returnValue("I have no recent orderbook data. Please try again later.")
             log.debug("Flair status called without current bid/ask set.")
-        last = yield self.check_last(user)
+        last = yield self.check_last(user, league)
         if last:
             since_change = datetime.datetime.utcnow() - datetime.datetime.utcfromtimestamp(last.time)
             date_str = utils.format_timedelta(since_change)
-            balance_str = ""
-            price_str = "%.2f" % (last.price/Flair.usdpip)
-            pl = 0
-            if last.type == 'bear':
-                pl = (last.price / (self.watcher.lowestask * Flair.usdpip) * 100) - 100
-                balance_str = "$%s" % (last.usd_amt/Flair.usdpip)
-            elif last.type == 'bull':
-                pl = (self.watcher.highestbid * Flair.usdpip / last.price * 100) - 100
-                balance_str = "%.4f BTC" % (last.btc_amt / Flair.btcpip)
+            balance_str = self._balance_str(last)
+            price_str = fixedpoint.format_cents(last.price)
+            mark = self.league(league).marks.mark(last)
+            if mark is None:
+                defer.returnValue("I have no recent orderbook data. Please try again later.")
+            pl = mark.pl_bp
             if pl > 0:
                 pl_str = "+"
             else:
                 pl_str = ""
-            pl_str += ("%.2f" % (pl)) + '%'
+            pl_str += fixedpoint.format_bp(pl) + '%'
 
             # "user is bear from $653.12 (P/L 1.23%) with X btc/usd for 3 days, 4 hours, and 5 minutes."
-            ret = "%s is %s from %s (P/L %s) with %s" % (last.user, last.type, price_str, pl_str, balance_str)
+            ret = "%s is %s from %s" % (last.user, last.type, price_str)
+            if holds_both_sides(last):
+                ret += ", still %s from %s" % (self._other_type(last.type), fixedpoint.format_cents(last.other_price))
+            ret += " (P/L %s) with %s" % (pl_str, balance_str)
             if len(date_str) > 0:
                 ret += " for %s" % date_str
             ret += "."
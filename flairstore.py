@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+
+import logging
+import os
+from collections import namedtuple
+
+from twisted.internet import defer
+from twisted.enterprise import adbapi
+
+try:
+    from txpostgres import txpostgres
+except ImportError:
+    txpostgres = None
+
+from twobitbot.utils import fixedpoint
+
+log = logging.getLogger(__name__)
+
+# Amounts are fixedpoint ints as stored in the DB: price and usd_amt in cents, btc_amt in units of 0.0001 BTC.
+# price is the entry price of what is held for the flair type (BTC for bulls, USD for bears), and other_price that
+# of anything still held on the other side from before, 0 if there is none or it's the starting balance.
+FlairRow = namedtuple('FlairRow', ['user', 'type', 'price', 'usd_amt', 'btc_amt', 'time', 'other_price'])
+FlairRow.__new__.__defaults__ = (0,)
+# Closed flair positions for a user: count, how many made money, best and worst return in basis points,
+# and growth, the product of (1 + return * part of the holdings closed) over all of them.
+FlairStats = namedtuple('FlairStats', ['trades', 'wins', 'best_bp', 'worst_bp', 'growth'])
+NO_STATS = FlairStats(0, 0, None, None, 1.0)
+
+
+def trade_return_bp(old_type, old_price, new_price):
+    """Return in basis points of a position opened as old_type at old_price and closed at new_price.
+    Prices are in the same units; the result is rounded half up."""
+    if old_type == 'bull':
+        return fixedpoint.ratio_bp(new_price, old_price)
+    return fixedpoint.ratio_bp(old_price, new_price)
+
+
+def add_trade_to_stats(stats, return_bp, closed=1):
+    """Stats with a trade added. closed is the part of the user's holdings, at cost, that was closed, which the
+    trade's effect on growth is scaled by; a partial close still counts as one trade."""
+    return FlairStats(stats.trades + 1, stats.wins + (1 if return_bp > 0 else 0),
+                      return_bp if stats.best_bp is None else max(stats.best_bp, return_bp),
+                      return_bp if stats.worst_bp is None else min(stats.worst_bp, return_bp),
+                      stats.growth * (1 + closed * return_bp / 10000.0))
+
+
+def open_store(location):
+    """FlairStore for a flair_db config value, either a postgres:// URL or the path of an sqlite3 DB."""
+    if location.startswith(('postgres://', 'postgresql://')):
+        return PostgresFlairStore(location)
+    return SqliteFlairStore(location)
+
+
+class FlairStore(object):
+    """Where flair is kept between restarts.
+
+    Flair answers everything it can from memory, so a store only has to load a league's current state when
+    it is first used, write batches of updates, and read history. Every method returns a Deferred.
+    Data is partitioned by league, a lowercase name where '' is the original global game.
+    Current flair rows are in FlairRow order. A batch is a list of (league, row, stats row or None), where a
+    stats row is (user,) followed by the FlairStats fields."""
+
+    def __init__(self):
+        self.change_observers = list()
+
+    def start(self):
+        """Connect and bring the schema up to date."""
+        raise NotImplementedError
+
+    @property
+    def running(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def load_current(self, league):
+        """Every user's current flair in a league, as rows in FlairRow order."""
+        raise NotImplementedError
+
+    def load_stats(self, league):
+        """Rows of (user, trades, wins, best_bp, worst_bp, growth) for every user in a league with stats."""
+        raise NotImplementedError
+
+    def load_user(self, league, user):
+        """(current flair row or None, stats row or None) for one user."""
+        raise NotImplementedError
+
+    def write_batch(self, batch):
+        raise NotImplementedError
+
+    def history(self, league, user, count):
+        """Rows of (user, flairstatus, flairprice, timestamp) for a user's latest changes, newest first."""
+        raise NotImplementedError
+
+    def add_change_observer(self, callback):
+        """callback is called with (league, username) whenever another bot sharing the store changes that
+        user's flair. Only stores that can be shared between bots ever call it."""
+        self.change_observers.append(callback)
+
+    def _send_change(self, league, user):
+        for cb in self.change_observers:
+            cb(league, user)
+
+
+def _backfill_flair_stats(txn):
+    """Compute flair_stats from the full history. Only run once, when migrating an existing DB."""
+    txn.execute("SELECT user, flairstatus, flairprice FROM ircflair ORDER BY user, timestamp, id")
+    stats = dict()
+    last = dict()
+    for user, flairstatus, price in txn.fetchall():
+        key = user.lower()
+        prev = last.get(key)
+        if prev is not None and prev[0] != flairstatus and prev[1] and price:
+            stats[key] = (user, add_trade_to_stats(stats.get(key, (user, NO_STATS))[1],
+                                                   trade_return_bp(prev[0], prev[1], price)))
+        last[key] = (flairstatus, price)
+    txn.executemany("""INSERT OR REPLACE INTO flair_stats (user, trades, wins, best_bp, worst_bp, growth)
+                    VALUES (?, ?, ?, ?, ?, ?)""", [(user,) + tuple(s) for user, s in stats.itervalues()])
+
+# Each entry migrates the sqlite flair DB schema up one version, tracked with sqlite's user_version.
+# Entries are SQL statements, or functions that are passed the transaction.
+SCHEMA_MIGRATIONS = [
+    # 1: flair history
+    ["""CREATE TABLE IF NOT EXISTS ircflair (id INTEGER PRIMARY KEY,
+     user TEXT COLLATE NOCASE, flairstatus TEXT, flairprice INTEGER, usd_amount INTEGER,
+     btc_amount INTEGER, timestamp INTEGER)"""],
+    # 2: covering index for per-user history, and a table holding only each user's current flair
+    ["""CREATE INDEX IF NOT EXISTS ircflair_user_time ON ircflair (user, timestamp,
+     flairstatus, flairprice, usd_amount, btc_amount)""",
+     """CREATE TABLE IF NOT EXISTS flair_current (user TEXT COLLATE NOCASE PRIMARY KEY,
+     flairstatus TEXT, flairprice INTEGER, usd_amount INTEGER, btc_amount INTEGER, timestamp INTEGER)""",
+     """INSERT OR REPLACE INTO flair_current (user, flairstatus, flairprice, usd_amount, btc_amount, timestamp)
+     SELECT user, flairstatus, flairprice, usd_amount, btc_amount, max(timestamp) FROM ircflair GROUP BY user"""],
+    # 3: per-user statistics on closed positions, kept up to date with each flair change
+    ["""CREATE TABLE IF NOT EXISTS flair_stats (user TEXT COLLATE NOCASE PRIMARY KEY,
+     trades INTEGER, wins INTEGER, best_bp INTEGER, worst_bp INTEGER, growth REAL)""",
+     _backfill_flair_stats],
+    # 4: leagues. league becomes the leading key of everything, with existing flair in the global league ''.
+    # Current flair and stats are clustered on (league, user) so loading a league reads one contiguous range.
+    ["ALTER TABLE ircflair ADD COLUMN league TEXT NOT NULL DEFAULT ''",
+     "DROP INDEX IF EXISTS ircflair_user_time",
+     """CREATE INDEX IF NOT EXISTS ircflair_league_user_time ON ircflair (league, user, timestamp,
+     flairstatus, flairprice, usd_amount, btc_amount)""",
+     "ALTER TABLE flair_current RENAME TO flair_current_v3",
+     """CREATE TABLE flair_current (league TEXT NOT NULL DEFAULT '', user TEXT COLLATE NOCASE,
+     flairstatus TEXT, flairprice INTEGER, usd_amount INTEGER, btc_amount INTEGER, timestamp INTEGER,
+     PRIMARY KEY (league, user)) WITHOUT ROWID""",
+     """INSERT INTO flair_current (league, user, flairstatus, flairprice, usd_amount, btc_amount, timestamp)
+     SELECT '', user, flairstatus, flairprice, usd_amount, btc_amount, timestamp FROM flair_current_v3""",
+     "DROP TABLE flair_current_v3",
+     "ALTER TABLE flair_stats RENAME TO flair_stats_v3",
+     """CREATE TABLE flair_stats (league TEXT NOT NULL DEFAULT '', user TEXT COLLATE NOCASE,
+     trades INTEGER, wins INTEGER, best_bp INTEGER, worst_bp INTEGER, growth REAL,
+     PRIMARY KEY (league, user)) WITHOUT ROWID""",
+     """INSERT INTO flair_stats (league, user, trades, wins, best_bp, worst_bp, growth)
+     SELECT '', user, trades, wins, best_bp, worst_bp, growth FROM flair_stats_v3""",
+     "DROP TABLE flair_stats_v3"],
+    # 5: entry price of what's still held on the other side of a flair change
+    ["ALTER TABLE ircflair ADD COLUMN otherprice INTEGER NOT NULL DEFAULT 0",
+     "ALTER TABLE flair_current ADD COLUMN otherprice INTEGER NOT NULL DEFAULT 0"],
+]
+
+
+class SqliteFlairStore(FlairStore):
+    """Flair in a local sqlite3 file, accessed from twisted's thread pool."""
+
+    def __init__(self, path):
+        super(SqliteFlairStore, self).__init__()
+        self.path = path
+        self.dbpool = None
+
+    def start(self):
+        self.dbpool = adbapi.ConnectionPool('sqlite3', self.path, check_same_thread=False,
+                                            cp_openfun=self._setup_connection)
+        if not self.dbpool:
+            raise IOError("Could not load flair DB {0}".format(self.path))
+        return self.dbpool.runInteraction(self._migrate)
+
+    @property
+    def running(self):
+        return self.dbpool is not None and self.dbpool.running
+
+    def close(self):
+        self.dbpool.close()
+
+    @staticmethod
+    def _setup_connection(conn):
+        # WAL lets lookups run while a batch of updates is being written
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+
+    def _migrate(self, txn):
+        txn.execute("PRAGMA user_version")
+        version = txn.fetchone()[0]
+        for new_version in xrange(version + 1, len(SCHEMA_MIGRATIONS) + 1):
+            log.info("Migrating flair DB %s to schema version %d" % (self.path, new_version))
+            for statement in SCHEMA_MIGRATIONS[new_version - 1]:
+                if callable(statement):
+                    statement(txn)
+                else:
+                    txn.execute(statement)
+            txn.execute("PRAGMA user_version = %d" % (new_version))
+
+    def load_current(self, league):
+        return self.dbpool.runQuery("""SELECT user, flairstatus, flairprice, usd_amount, btc_amount, timestamp,
+                                    otherprice FROM flair_current WHERE league = ?""", (league,))
+
+    def load_stats(self, league):
+        return self.dbpool.runQuery("""SELECT user, trades, wins, best_bp, worst_bp, growth FROM flair_stats
+                                    WHERE league = ?""", (league,))
+
+    def load_user(self, league, user):
+        return self.dbpool.runInteraction(self._load_user, league, user)
+
+    @staticmethod
+    def _load_user(txn, league, user):
+        txn.execute("""SELECT user, flairstatus, flairprice, usd_amount, btc_amount, timestamp, otherprice
+                    FROM flair_current WHERE league = ? AND user = ?""", (league, user))
+        current = txn.fetchone()
+        txn.execute("""SELECT user, trades, wins, best_bp, worst_bp, growth FROM flair_stats
+                    WHERE league = ? AND user = ?""", (league, user))
+        return current, txn.fetchone()
+
+    def write_batch(self, batch):
+        return self.dbpool.runInteraction(self._write_batch, batch)
+
+    @staticmethod
+    def _write_batch(txn, batch):
+        rows = [(league,) + tuple(row) for league, row, _ in batch]
+        txn.executemany("""INSERT INTO ircflair(league, user, flairstatus, flairprice, usd_amount, btc_amount,
+                        timestamp, otherprice) VALUES(?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+        txn.executemany("""INSERT OR REPLACE INTO flair_current(league, user, flairstatus, flairprice, usd_amount,
+                        btc_amount, timestamp, otherprice) VALUES(?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+        txn.executemany("""INSERT OR REPLACE INTO flair_stats(league, user, trades, wins, best_bp, worst_bp, growth)
+                        VALUES(?, ?, ?, ?, ?, ?, ?)""",
+                        [(league,) + tuple(stats) for league, _, stats in batch if stats is not None])
+
+    def history(self, league, user, count):
+        return self.dbpool.runQuery("""SELECT user, flairstatus, flairprice, timestamp FROM ircflair
+                                    WHERE league = ? AND user = ? ORDER BY timestamp DESC, id DESC LIMIT ?""",
+                                    (league, user, count))
+
+
+# Postgres has no NOCASE collation, so each table also stores user_key, the lowercased username, to look users up by.
+# History is hash partitioned on league, so one busy league doesn't slow down lookups in the others.
+# Every statement is idempotent, and they are run under an advisory lock so bots starting together don't collide.
+POSTGRES_HISTORY_PARTITIONS = 16
+POSTGRES_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS ircflair (id BIGSERIAL, league TEXT NOT NULL, "user" TEXT, user_key TEXT,
+    flairstatus TEXT, flairprice BIGINT, usd_amount BIGINT, btc_amount BIGINT, timestamp BIGINT,
+    PRIMARY KEY (league, id)) PARTITION BY HASH (league)""",
+] + ["""CREATE TABLE IF NOT EXISTS ircflair_%d PARTITION OF ircflair
+     FOR VALUES WITH (MODULUS %d, REMAINDER %d)""" % (i, POSTGRES_HISTORY_PARTITIONS, i)
+     for i in xrange(POSTGRES_HISTORY_PARTITIONS)] + [
+    """CREATE INDEX IF NOT EXISTS ircflair_league_user_time ON ircflair (league, user_key, timestamp DESC, id DESC)""",
+    """CREATE TABLE IF NOT EXISTS flair_current (league TEXT NOT NULL, user_key TEXT, "user" TEXT,
+    flairstatus TEXT, flairprice BIGINT, usd_amount BIGINT, btc_amount BIGINT, timestamp BIGINT,
+    PRIMARY KEY (league, user_key))""",
+    """CREATE TABLE IF NOT EXISTS flair_stats (league TEXT NOT NULL, user_key TEXT, "user" TEXT,
+    trades INTEGER, wins INTEGER, best_bp INTEGER, worst_bp INTEGER, growth DOUBLE PRECISION,
+    PRIMARY KEY (league, user_key))""",
+    # added after the tables above were first created
+    "ALTER TABLE ircflair ADD COLUMN IF NOT EXISTS otherprice BIGINT NOT NULL DEFAULT 0",
+    "ALTER TABLE flair_current ADD COLUMN IF NOT EXISTS otherprice BIGINT NOT NULL DEFAULT 0",
+]
+
+# Statements prepared on every pooled connection, as name: (parameter types, statement).
+POSTGRES_STATEMENTS = {
+    'flair_insert': ("text, text, text, bigint, bigint, bigint, bigint, bigint",
+                     """INSERT INTO ircflair (league, "user", user_key, flairstatus, flairprice, usd_amount,
+                     btc_amount, timestamp, otherprice) VALUES ($1, $2, lower($2), $3, $4, $5, $6, $7, $8)"""),
+    'flair_set_current': ("text, text, text, bigint, bigint, bigint, bigint, bigint",
+                          """INSERT INTO flair_current (league, user_key, "user", flairstatus, flairprice,
+                          usd_amount, btc_amount, timestamp, otherprice)
+                          VALUES ($1, lower($2), $2, $3, $4, $5, $6, $7, $8)
+                          ON CONFLICT (league, user_key) DO UPDATE SET "user" = EXCLUDED."user",
+                          flairstatus = EXCLUDED.flairstatus, flairprice = EXCLUDED.flairprice,
+                          usd_amount = EXCLUDED.usd_amount, btc_amount = EXCLUDED.btc_amount,
+                          timestamp = EXCLUDED.timestamp, otherprice = EXCLUDED.otherprice"""),
+    'flair_set_stats': ("text, text, integer, integer, integer, integer, double precision",
+                        """INSERT INTO flair_stats (league, user_key, "user", trades, wins, best_bp, worst_bp,
+                        growth) VALUES ($1, lower($2), $2, $3, $4, $5, $6, $7)
+                        ON CONFLICT (league, user_key) DO UPDATE SET "user" = EXCLUDED."user",
+                        trades = EXCLUDED.trades, wins = EXCLUDED.wins, best_bp = EXCLUDED.best_bp,
+                        worst_bp = EXCLUDED.worst_bp, growth = EXCLUDED.growth"""),
+    'flair_league_current': ("text",
+                             """SELECT "user", flairstatus, flairprice, usd_amount, btc_amount, timestamp,
+                             otherprice FROM flair_current WHERE league = $1"""),
+    'flair_league_stats': ("text",
+                           """SELECT "user", trades, wins, best_bp, worst_bp, growth FROM flair_stats
+                           WHERE league = $1"""),
+    'flair_current_of': ("text, text",
+                         """SELECT "user", flairstatus, flairprice, usd_amount, btc_amount, timestamp,
+                         otherprice FROM flair_current WHERE league = $1 AND user_key = lower($2)"""),
+    'flair_stats_of': ("text, text",
+                       """SELECT "user", trades, wins, best_bp, worst_bp, growth FROM flair_stats
+                       WHERE league = $1 AND user_key = lower($2)"""),
+    'flair_history': ("text, text, integer",
+                      """SELECT "user", flairstatus, flairprice, timestamp FROM ircflair
+                      WHERE league = $1 AND user_key = lower($2) ORDER BY timestamp DESC, id DESC LIMIT $3"""),
+}
+
+if txpostgres is not None:
+    class _PreparedConnection(txpostgres.Connection):
+        """Connection that prepares POSTGRES_STATEMENTS as soon as it connects."""
+
+        def connect(self, *args, **kwargs):
+            d = txpostgres.Connection.connect(self, *args, **kwargs)
+            d.addCallback(self._prepare)
+            return d
+
+        @defer.inlineCallbacks
+        def _prepare(self, _):
+            for name, (types, statement) in POSTGRES_STATEMENTS.iteritems():
+                yield self.runOperation("PREPARE %s (%s) AS %s" % (name, types, statement))
+            defer.returnValue(self)
+
+    class _PreparedConnectionPool(txpostgres.ConnectionPool):
+        connectionFactory = _PreparedConnection
+
+
+class PostgresFlairStore(FlairStore):
+    """Flair in a PostgreSQL DB, so several bots can share one flair game.
+
+    Uses txpostgres, which talks to postgres asynchronously from the reactor, over a pool of connections
+    with every statement prepared up front. When a bot writes flair changes it sends a NOTIFY with the users
+    changed, and the other bots reload those users."""
+    channel = 'flair_changed'
+    # arbitrary key for the advisory lock taken while creating the schema
+    schema_lock = 0x7462
+    # changes per NOTIFY, which keeps payloads of nicknames and league names well under postgres' 8000 byte limit
+    notify_users = 50
+    # the schema uses hash partitioning, new in postgres 11
+    min_server_version = 110000
+
+    def __init__(self, dsn, connections=3):
+        if txpostgres is None:
+            raise ImportError("txpostgres is required to store flair in postgres.")
+        super(PostgresFlairStore, self).__init__()
+        self.dsn = dsn
+        self.pool = _PreparedConnectionPool(None, dsn, min=connections)
+        # a separate connection, outside the pool, that sits in LISTEN
+        self.listener = txpostgres.Connection()
+        # tags our own notifications so we don't reload changes we made
+        self.instance_id = os.urandom(6).encode('hex')
+        self._running = False
+
+    @defer.inlineCallbacks
+    def start(self):
+        yield self.pool.start()
+        version = yield self.pool.runQuery("SHOW server_version_num")
+        if int(version[0][0]) < self.min_server_version:
+            self.pool.close()
+            raise IOError("Postgres 11 or later is required to store flair, the server is version %s" %
+                          (version[0][0]))
+        yield self.pool.runInteraction(self._create_schema)
+        yield self.listener.connect(self.dsn)
+        self.listener.addNotifyObserver(self._on_notify)
+        yield self.listener.runOperation("LISTEN %s" % (self.channel))
+        self._running = True
+        log.info("Connected to postgres flair DB")
+
+    @staticmethod
+    @defer.inlineCallbacks
+    def _create_schema(cursor):
+        yield cursor.execute("SELECT pg_advisory_xact_lock(%s)", (PostgresFlairStore.schema_lock,))
+        for statement in POSTGRES_SCHEMA:
+            yield cursor.execute(statement)
+
+    @property
+    def running(self):
+        return self._running
+
+    def close(self):
+        self._running = False
+        self.listener.close()
+        self.pool.close()
+
+    def load_current(self, league):
+        return self.pool.runQuery("EXECUTE flair_league_current (%s)", (league,))
+
+    def load_stats(self, league):
+        return self.pool.runQuery("EXECUTE flair_league_stats (%s)", (league,))
+
+    @defer.inlineCallbacks
+    def load_user(self, league, user):
+        current = yield self.pool.runQuery("EXECUTE flair_current_of (%s, %s)", (league, user))
+        stats = yield self.pool.runQuery("EXECUTE flair_stats_of (%s, %s)", (league, user))
+        defer.returnValue((current[0] if current else None, stats[0] if stats else None))
+
+    def write_batch(self, batch):
+        return self.pool.runInteraction(self._write_batch, batch)
+
+    @defer.inlineCallbacks
+    def _write_batch(self, cursor, batch):
+        for league, row, stats in batch:
+            row = (league,) + tuple(row)
+            yield cursor.execute("EXECUTE flair_insert (%s, %s, %s, %s, %s, %s, %s, %s)", row)
+            yield cursor.execute("EXECUTE flair_set_current (%s, %s, %s, %s, %s, %s, %s, %s)", row)
+            if stats is not None:
+                yield cursor.execute("EXECUTE flair_set_stats (%s, %s, %s, %s, %s, %s, %s)",
+                                     (league,) + tuple(stats))
+        # notifications are sent when the transaction commits. Each change is user@league, which is unambiguous
+        # since nicknames can't contain @ or spaces.
+        changes = sorted(set("%s@%s" % (row[0].lower(), league) for league, row, _ in batch))
+        for i in xrange(0, len(changes), self.notify_users):
+            yield cursor.execute("SELECT pg_notify(%s, %s)",
+                                 (self.channel, ' '.join([self.instance_id] + changes[i:i + self.notify_users])))
+
+    def history(self, league, user, count):
+        return self.pool.runQuery("EXECUTE flair_history (%s, %s, %s)", (league, user, count))
+
+    def _on_notify(self, notify):
+        changes = notify.payload.split(' ')
+        if changes[0] == self.instance_id:
+            return
+        for change in changes[1:]:
+            user, league = change.split('@', 1)
+            self._send_change(league, user)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+import logging
+from bisect import bisect_left, insort
+
+from twobitbot.utils import fixedpoint
+
+log = logging.getLogger(__name__)
+
+# Order between kinds of position worth exactly the same: all BTC, then a mix, then all USD.
+BTC, MIXED, USD = 2, 1, 0
+
+
+class Leaderboard(object):
+    """Flair standings, kept sorted as flairs change.
+
+    Users holding only BTC rank among themselves by BTC held at any given price, and users holding only USD by
+    USD held. Each group is kept in its own sorted list, and the overall order at the current price is found
+    by merging them from the top, which costs O(k) for the top k users no matter how many users there are
+    or how much the price has moved. Bisecting the lists also gives any user's rank, or the start of any page
+    of the standings, in logarithmic time.
+
+    Users holding both, after sizing a position partially, have no fixed order among themselves as the
+    price moves. They are kept sorted by value at the last bid read, with changes inserted at that bid in
+    O(log m). The first read at a new bid revalues them in their previous order and re-sorts, which is O(m)
+    for m mixed users: a small move only swaps a few of them, and Python's sort only has to fix those.
+    They are then merged in like the other two groups.
+
+    Users are ordered by value, then by kind of position (see BTC, MIXED and USD), then by name."""
+
+    def __init__(self):
+        # ascending lists of (amount in fixedpoint units, lowercased user)
+        self._btc = list()
+        self._usd = list()
+        # lowercased user -> FlairRow for users holding both
+        self._mixed = dict()
+        # (bid, ascending list of their full keys at that bid) for users holding both, see _mixed_at
+        self._mixed_sorted = None
+        # lowercased user -> (sorted list it is in, or None if holding both, its key there, FlairRow)
+        self._entries = dict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def update(self, row):
+        """Add or move a user, given their latest FlairRow."""
+        user = row.user.lower()
+        self.remove(user)
+        if row.usd_amt and row.btc_amt:
+            self._mixed[user] = row
+            if self._mixed_sorted is not None:
+                bid, keys = self._mixed_sorted
+                insort(keys, self._mixed_key(row, user, bid))
+            self._entries[user] = (None, None, row)
+            return
+        if row.btc_amt:
+            ranking, key = self._btc, (row.btc_amt, user)
+        else:
+            ranking, key = self._usd, (row.usd_amt, user)
+        insort(ranking, key)
+        self._entries[user] = (ranking, key, row)
+
+    def remove(self, user):
+        user = user.lower()
+        entry = self._entries.pop(user, None)
+        if entry is None:
+            return
+        ranking, key, _ = entry
+        if ranking is None:
+            row = self._mixed.pop(user)
+            if self._mixed_sorted is not None:
+                bid, keys = self._mixed_sorted
+                del keys[bisect_left(keys, self._mixed_key(row, user, bid))]
+        else:
+            del ranking[bisect_left(ranking, key)]
+
+    @staticmethod
+    def value(row, bid):
+        """Value in cents of a FlairRow at the bid (in cents)."""
+        return row.usd_amt + fixedpoint.btc_value_cents(row.btc_amt, bid)
+
+    @staticmethod
+    def _mixed_key(row, user, bid):
+        return row.usd_amt * fixedpoint.BTC_PIP + row.btc_amt * bid, MIXED, user
+
+    def _full_key(self, ranking, key, bid):
+        """Key that orders users across all lists at bid: (value in cents * BTC_PIP, kind, user).
+        Scaling the value up keeps comparisons exact."""
+        if ranking is self._btc:
+            return key[0] * bid, BTC, key[1]
+        elif ranking is self._usd:
+            return key[0] * fixedpoint.BTC_PIP, USD, key[1]
+        return key
+
+    def _mixed_at(self, bid):
+        """Ascending full keys of users holding both BTC and USD at bid."""
+        if self._mixed_sorted is None:
+            keys = sorted(self._mixed_key(row, user, bid) for user, row in self._mixed.iteritems())
+        elif self._mixed_sorted[0] != bid:
+            # still nearly in order unless the bid moved a long way, which sorting takes advantage of
+            keys = [self._mixed_key(self._mixed[key[2]], key[2], bid) for key in self._mixed_sorted[1]]
+            keys.sort()
+        else:
+            return self._mixed_sorted[1]
+        self._mixed_sorted = (bid, keys)
+        return keys
+
+    def _rankings(self, bid):
+        return self._btc, self._mixed_at(bid), self._usd
+
+    @staticmethod
+    def _first(ranking, pred):
+        """Index of the first key in ranking for which pred is true, where pred is monotonic."""
+        lo, hi = 0, len(ranking)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if pred(ranking[mid]):
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def _ahead(self, full_key, bid):
+        """Number of users ranked ahead of a user with full_key."""
+        ahead = 0
+        for ranking in self._rankings(bid):
+            ahead += len(ranking) - self._first(ranking, lambda key: self._full_key(ranking, key, bid) > full_key)
+        return ahead
+
+    def rank(self, user, bid):
+        """1-based rank of user valued at `bid`, or None if they aren't on the leaderboard. O(log n)."""
+        user = user.lower()
+        entry = self._entries.get(user)
+        if entry is None:
+            return None
+        ranking, key, row = entry
+        if ranking is None:
+            full_key = self._mixed_key(row, user, bid)
+        else:
+            full_key = self._full_key(ranking, key, bid)
+        return self._ahead(full_key, bid) + 1
+
+    def top(self, count, bid, offset=0):
+        """`count` users valued at `bid`, starting after the best `offset`, as a list of (FlairRow, value in cents).
+        Finding where to start takes O(log^2 n), then each user returned is O(1)."""
+        rankings = self._rankings(bid)
+        # for each list, the index just past the next user to return, found by bisecting on rank
+        idxs = [self._first(ranking, lambda key: self._ahead(self._full_key(ranking, key, bid), bid) < offset)
+                if offset else len(ranking) for ranking in rankings]
+
+        ret = list()
+        while len(ret) < count:
+            best = None
+            for i, ranking in enumerate(rankings):
+                if idxs[i] > 0:
+                    full_key = self._full_key(ranking, ranking[idxs[i] - 1], bid)
+                    if best is None or full_key > best[1]:
+                        best = (i, full_key)
+            if best is None:
+                break
+            idxs[best[0]] -= 1
+            row = self._entries[best[1][2]][2]
+            ret.append((row, self.value(row, bid)))
+        return ret
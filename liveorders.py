@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+import logging
+from collections import OrderedDict
+from itertools import count
+
+from twobitbot import utils
+
+log = logging.getLogger(__name__)
+
+
+class LiveOrder(object):
+    __slots__ = ('price', 'amount', 'is_bid', 'created', 'seq')
+
+    def __init__(self, price, amount, is_bid, created, seq):
+        self.price = price
+        self.amount = amount
+        self.is_bid = is_bid
+        self.created = created
+        # arrival order, since many orders share the same second
+        self.seq = seq
+
+
+class LiveOrderStore(object):
+    """Bounded store of open orders from a live orders stream, indexed by order id.
+
+    Orders are kept in arrival order, so the oldest are evicted first once there are more than
+    max_orders of them or they are older than max_age seconds. Memory stays flat no matter how many
+    orders are created and cancelled."""
+
+    def __init__(self, max_orders=20000, max_age=60*60):
+        self.max_orders = max_orders
+        self.max_age = max_age
+        self.orders = OrderedDict()
+        self._seq = count()
+
+    def __len__(self):
+        return len(self.orders)
+
+    def __contains__(self, order_id):
+        return order_id in self.orders
+
+    def get(self, order_id):
+        return self.orders.get(order_id)
+
+    def created(self, order_id, price, amount, is_bid):
+        now = utils.now_in_utc_secs()
+        self.orders.pop(order_id, None)
+        self.orders[order_id] = LiveOrder(price, amount, is_bid, now, next(self._seq))
+        self._evict(now)
+
+    def changed(self, order_id, amount):
+        order = self.orders.get(order_id)
+        if order is not None:
+            order.amount = amount
+
+    def deleted(self, order_id):
+        self.orders.pop(order_id, None)
+
+    def _evict(self, now):
+        while len(self.orders) > self.max_orders:
+            self.orders.popitem(last=False)
+        oldest = now - self.max_age
+        while self.orders:
+            order_id, order = next(self.orders.iteritems())
+            if order.created >= oldest:
+                break
+            del self.orders[order_id]
+
+    def taker_is_buy(self, buy_order_id, sell_order_id):
+        """Determine which side of a trade took liquidity, using the resting (maker) order.
+        Returns True if the buyer was the taker, False if the seller was, or None if unknown.
+
+        Both orders have to be known: if only one is, the other may have arrived earlier and already
+        been evicted, so which one rested first can't be told."""
+        buy = self.orders.get(buy_order_id)
+        sell = self.orders.get(sell_order_id)
+        if buy is None or sell is None:
+            return None
+        # both were resting at some point, the older one is the maker
+        return buy.seq > sell.seq
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+import logging
+from collections import namedtuple
+
+from twobitbot import utils
+from twobitbot.utils import fixedpoint
+
+log = logging.getLogger(__name__)
+
+# A flair position valued at a snapshot's prices: the FlairRow, its value in cents, and its P/L in basis points.
+Mark = namedtuple('Mark', ['row', 'value', 'pl_bp'])
+
+
+def holds_both_sides(row):
+    """Whether a FlairRow still holds some of the side opposite its flair type, with an entry price of its own."""
+    return bool(row.other_price and (row.usd_amt if row.type == 'bull' else row.btc_amt))
+
+
+def mark_position(row, bid, ask):
+    """Mark for one FlairRow at bid/ask in cents. BTC is valued at the bid. P/L is for what the user holds since
+    buying it: BTC against the bid, and USD against the ask, the price they would buy back in at. If they hold
+    both, each side's P/L is weighted by what it cost."""
+    value = row.usd_amt + fixedpoint.btc_value_cents(row.btc_amt, bid)
+    if not holds_both_sides(row):
+        if row.type == 'bull':
+            return Mark(row, value, fixedpoint.ratios_bp([bid], [row.price])[0])
+        return Mark(row, value, fixedpoint.ratios_bp([row.price], [ask])[0])
+    bull_price, bear_price = (row.price, row.other_price) if row.type == 'bull' else (row.other_price, row.price)
+    bull_pl, bear_pl = fixedpoint.ratios_bp([bid, bear_price], [bull_price, ask])
+    bull_cost = fixedpoint.btc_value_cents(row.btc_amt, bull_price)
+    pl = fixedpoint.div_round(bull_pl * bull_cost + bear_pl * row.usd_amt, bull_cost + row.usd_amt)
+    return Mark(row, value, pl)
+
+
+class MarkSnapshot(namedtuple('MarkSnapshot', ['version', 'bid', 'ask', 'time', 'marks'])):
+    """Every open flair position valued at one bid/ask (in cents). marks maps lowercased users to Marks.
+
+    Snapshots are never modified once published, so they can be read from anywhere without copying.
+    Users whose flair changed after the snapshot was taken are valued on the fly at the snapshot's prices."""
+    __slots__ = ()
+
+    def mark(self, row):
+        """Mark for a FlairRow at this snapshot's prices."""
+        mark = self.marks.get(row.user.lower())
+        if mark is not None and mark.row is row:
+            return mark
+        return mark_position(row, self.bid, self.ask)
+
+
+class MarkToMarket(object):
+    """Revalues all flair positions at once whenever the best bid or ask moves by more than epsilon.
+
+    positions is a dict of lowercased user to their current FlairRow, like Flair.latest. Readers call current(),
+    which only does any work when prices have moved far enough since the last snapshot; otherwise the
+    published snapshot is returned as is."""
+
+    def __init__(self, watcher, positions, epsilon=0):
+        """epsilon: smallest move of the bid or ask, in USD, that triggers revaluation. 0 revalues on any move."""
+        self.watcher = watcher
+        self.positions = positions
+        self.epsilon = fixedpoint.to_cents(epsilon)
+        self.snapshot = None
+        self.version = 0
+
+    def _moved(self, bid, ask):
+        if self.snapshot is None:
+            return True
+        return abs(bid - self.snapshot.bid) > self.epsilon or abs(ask - self.snapshot.ask) > self.epsilon
+
+    def prices(self):
+        """Current (bid, ask) in cents, or None if there are no prices."""
+        bid, ask = self.watcher.highestbid, self.watcher.lowestask
+        if not bid or not ask:
+            return None
+        return fixedpoint.to_cents(bid), fixedpoint.to_cents(ask)
+
+    def current(self):
+        """Latest MarkSnapshot, revaluing first if prices have moved. None if there are no prices."""
+        prices = self.prices()
+        if prices is not None and self._moved(*prices):
+            self.revalue(*prices)
+        return self.snapshot
+
+    def marked_prices(self):
+        """(bid, ask) in cents that positions are valued at right now: the snapshot's while prices are within
+        epsilon of it, otherwise current prices. None if there are no prices."""
+        prices = self.prices()
+        if prices is None or self._moved(*prices):
+            return prices
+        return self.snapshot.bid, self.snapshot.ask
+
+    def price_key(self):
+        """Current prices in whole multiples of epsilon, which changes whenever prices may have moved far enough
+        to revalue, without revaluing anything. None if there are no prices."""
+        prices = self.prices()
+        if prices is None or not self.epsilon:
+            return prices
+        return prices[0] // self.epsilon, prices[1] // self.epsilon
+
+    def mark(self, row):
+        """Mark for one FlairRow at current prices, taken from the snapshot if prices are still within epsilon
+        of it, and otherwise worked out for that row alone rather than revaluing everyone. None if there are
+        no prices."""
+        prices = self.marked_prices()
+        if prices is None:
+            return None
+        if self.snapshot is not None and prices == (self.snapshot.bid, self.snapshot.ask):
+            return self.snapshot.mark(row)
+        return mark_position(row, *prices)
+
+    def revalue(self, bid, ask):
+        """Value every position at bid/ask in cents and publish the result as a new snapshot."""
+        bulls = list()
+        bears = list()
+        # the few users holding both sides with their own entry prices are valued one at a time
+        mixed = list()
+        for row in self.positions.itervalues():
+            if holds_both_sides(row):
+                mixed.append(row)
+            elif row.type == 'bull':
+                bulls.append(row)
+            else:
+                bears.append(row)
+        rows = bulls + bears
+        btc_values = fixedpoint.btc_values_cents([row.btc_amt for row in rows], bid)
+        pls = fixedpoint.ratios_bp([bid] * len(bulls) + [row.price for row in bears],
+                                   [row.price for row in bulls] + [ask] * len(bears))
+
+        marks = dict()
+        for row, btc_value, pl in zip(rows, btc_values, pls):
+            marks[row.user.lower()] = Mark(row, row.usd_amt + btc_value, pl)
+        for row in mixed:
+            marks[row.user.lower()] = mark_position(row, bid, ask)
+
+        self.version += 1
+        self.snapshot = MarkSnapshot(self.version, bid, ask, utils.now_in_utc_secs(), marks)
+        log.debug("Revalued %d flair positions at bid %s, ask %s (snapshot %d)" %
+                  (len(marks), fixedpoint.format_cents(bid), fixedpoint.format_cents(ask), self.version))
+        return self.snapshot
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+import logging
+from bisect import bisect_left, bisect_right
+
+from twobitbot import utils
+
+log = logging.getLogger(__name__)
+
+
+class BookSide(object):
+    """One side of an order book, kept as a sorted array of price levels.
+
+    Levels are ordered best first (highest bid, lowest ask). Best price and level updates are
+    found with bisection. Cumulative volume uses prefix sums that a change only invalidates from
+    its level down, and that queries only extend as deep as they ask for. Most changes are near
+    the top of the book, so queries cost O(log n) plus the few levels recomputed."""
+
+    def __init__(self, is_bid):
+        self.is_bid = is_bid
+        # sort keys, best first: negated prices for bids, prices for asks
+        self._keys = list()
+        self._amounts = dict()
+        # running totals of amounts for the best levels, valid for as many levels as it is long
+        self._cumulative = list()
+        # sort keys of the worst level in the latest and the previous snapshot, None if not bounded by one
+        self._window_end = None
+        self._prev_window_end = None
+
+    def _key(self, price):
+        return -price if self.is_bid else price
+
+    def _price(self, key):
+        return -key if self.is_bid else key
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, price):
+        return price in self._amounts
+
+    def __iter__(self):
+        """Iterate over (price, amount) levels, best first."""
+        for key in self._keys:
+            price = self._price(key)
+            yield price, self._amounts[price]
+
+    def amount_at(self, price):
+        return self._amounts.get(price, 0)
+
+    def update(self, price, amount):
+        """Set the amount resting at a price level, removing the level if amount is 0.
+        Returns the previous amount at that level."""
+        old = self._amounts.get(price, 0)
+        if amount == old:
+            return old
+        key = self._key(price)
+        idx = bisect_left(self._keys, key)
+        if amount <= 0:
+            if price in self._amounts:
+                del self._amounts[price]
+                del self._keys[idx]
+        else:
+            if price not in self._amounts:
+                self._keys.insert(idx, key)
+            self._amounts[price] = amount
+        # totals above this level are unaffected
+        del self._cumulative[idx:]
+        return old
+
+    def replace(self, levels):
+        """Replace the side with a snapshot of [price, amount] levels, touching only levels that changed.
+        Returns a list of (price, old_amount, new_amount) changes.
+
+        Snapshots only hold the best levels (Bitstamp sends 20), so the side only ever holds what the latest
+        snapshot shows. Whether a level left because it scrolled out of the window rather than being
+        cancelled can be told with in_window."""
+        new = dict()
+        for price, amount in levels:
+            new[price] = amount
+        self._prev_window_end = self._window_end
+        self._window_end = max(self._key(price) for price in new) if new else None
+        changes = list()
+        for price in [p for p in self._amounts if p not in new]:
+            changes.append((price, self.update(price, 0), 0))
+        for price, amount in new.iteritems():
+            if self._amounts.get(price, 0) != amount:
+                changes.append((price, self.update(price, amount), amount))
+        return changes
+
+    def in_window(self, price, previous=False):
+        """Whether price is within the latest snapshot, or the one before it if previous, i.e. no worse
+        than its worst level. Always true if the side isn't limited to a snapshot window."""
+        end = self._prev_window_end if previous else self._window_end
+        return end is None or self._key(price) <= end
+
+    def clear(self):
+        self._keys = list()
+        self._amounts = dict()
+        self._cumulative = list()
+        self._window_end = None
+        self._prev_window_end = None
+
+    def best(self):
+        """Best (price, amount) level, or None if the side is empty."""
+        if self._keys:
+            price = self._price(self._keys[0])
+            return price, self._amounts[price]
+
+    def best_price(self):
+        if self._keys:
+            return self._price(self._keys[0])
+
+    def depth(self, levels):
+        """The best `levels` price levels as a list of (price, amount)."""
+        return [(self._price(key), self._amounts[self._price(key)]) for key in self._keys[:levels]]
+
+    def volume_to(self, price):
+        """Cumulative amount resting from the best level up to and including price."""
+        idx = bisect_right(self._keys, self._key(price))
+        if idx == 0:
+            return 0
+        cumulative = self._cumulative
+        total = cumulative[-1] if cumulative else 0
+        for key in self._keys[len(cumulative):idx]:
+            total += self._amounts[self._price(key)]
+            cumulative.append(total)
+        return cumulative[idx - 1]
+
+
+class OrderBook(object):
+    """Local order book that can be updated from full snapshots or diffs.
+
+    Level listeners are called with (is_bid, price, old_amount, new_amount) for each level
+    that actually changed, so consumers never have to rescan the whole book."""
+
+    def __init__(self):
+        self.bids = BookSide(is_bid=True)
+        self.asks = BookSide(is_bid=False)
+        self.last_update = None
+        self.level_listeners = list()
+
+    def add_level_listener(self, callback):
+        if callable(callback):
+            self.level_listeners.append(callback)
+        else:
+            raise ValueError("Level listener must be callable.")
+
+    def _changed(self, is_bid, changes):
+        for price, old, new in changes:
+            for cb in self.level_listeners:
+                cb(is_bid, price, old, new)
+
+    def apply_snapshot(self, bids, asks):
+        """Update the book from full lists of [price, amount] bids and asks."""
+        bid_changes = self.bids.replace(bids)
+        ask_changes = self.asks.replace(asks)
+        # listeners can tell the initial snapshot apart since last_update is still None
+        self._changed(True, bid_changes)
+        self._changed(False, ask_changes)
+        self.last_update = utils.now_in_utc_secs()
+
+    def apply_diff(self, bids, asks):
+        """Update the book from lists of changed [price, amount] levels, where an amount of 0 removes the level."""
+        for is_bid, side, levels in ((True, self.bids, bids), (False, self.asks, asks)):
+            changes = list()
+            for price, amount in levels:
+                old = side.update(price, amount)
+                if old != amount:
+                    changes.append((price, old, amount))
+            self._changed(is_bid, changes)
+        self.last_update = utils.now_in_utc_secs()
+
+    def in_window(self, is_bid, price, previous=False):
+        """Whether a price on one side is within the latest snapshot (or the previous one), see BookSide.in_window."""
+        return (self.bids if is_bid else self.asks).in_window(price, previous)
+
+    def best_bid(self):
+        return self.bids.best_price()
+
+    def best_ask(self):
+        return self.asks.best_price()
+
+    def depth(self, levels):
+        """Dict with the best `levels` bids and asks, each a list of (price, amount)."""
+        return {'bids': self.bids.depth(levels), 'asks': self.asks.depth(levels)}
+
+    def volume_to_price(self, price):
+        """Cumulative volume between the top of the book and price.
+        Bids are used for prices at or below the best bid, asks otherwise."""
+        bid = self.best_bid()
+        if bid is not None and price <= bid:
+            return self.bids.volume_to(price)
+        return self.asks.volume_to(price)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+import logging
+import mmap
+import os
+import struct
+
+from twisted.internet import defer, reactor, threads
+
+from twobitbot.trades import Trade, side_from_is_buy, SIDE_BUY, SIDE_UNKNOWN
+
+log = logging.getLogger(__name__)
+
+
+class TradeTape(object):
+    """Append-only file of every trade seen, for historical queries without keeping history in memory.
+
+    Records are fixed width: UTC timestamp in ms, price, amount, running total volume, running total
+    notional (price*amount), and side. Thanks to the running totals, volume and VWAP between any two
+    times take two binary searches over the memory-mapped file, regardless of how many trades are in between.
+
+    Trades are buffered in memory and written in a thread, at most flush_delay seconds after they arrive,
+    so the reactor never blocks on disk. Queries only see trades that have been written."""
+    record = struct.Struct('<qddddb')
+
+    def __init__(self, path, flush_delay=1):
+        self.path = path
+        self.flush_delay = flush_delay
+        self._pending = list()
+        self._flush_call = None
+        # writes run one at a time in the order they were queued, so the tape stays sorted
+        self._write_lock = defer.DeferredLock()
+        self._stopping = False
+        self._map = None
+        self._map_size = 0
+
+        self.cum_volume = 0.0
+        self.cum_notional = 0.0
+        self.last_timestamp = 0
+        self._load_totals()
+
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def _load_totals(self):
+        """Continue running totals from the last complete record on disk."""
+        if not os.path.exists(self.path):
+            return
+        size = os.path.getsize(self.path)
+        count = size // self.record.size
+        if size % self.record.size:
+            # a partial record from a crash mid-write would misalign everything after it
+            log.warn("Truncating partial record at end of trade tape %s" % (self.path))
+            with open(self.path, 'r+b') as f:
+                f.truncate(count * self.record.size)
+        if count:
+            with open(self.path, 'rb') as f:
+                f.seek((count - 1) * self.record.size)
+                timestamp, _, _, self.cum_volume, self.cum_notional, _ = self.record.unpack(f.read(self.record.size))
+                self.last_timestamp = timestamp
+
+    def record_trade(self, trade):
+        """Trade callback, see ExchangeWatcher.add_trade_callback."""
+        amount = float(trade.amount)
+        price = float(trade.price)
+        # keep the tape sorted even if the clock steps backwards
+        timestamp = max(int(trade.timestamp), self.last_timestamp)
+        self.last_timestamp = timestamp
+        self.cum_volume += amount
+        self.cum_notional += amount * price
+        self._pending.append(self.record.pack(timestamp, price, amount, self.cum_volume, self.cum_notional,
+                                              side_from_is_buy(trade.is_buy)))
+        if self._flush_call is None and not self._stopping:
+            self._flush_call = reactor.callLater(self.flush_delay, self.flush)
+
+    def flush(self):
+        """Write pending trades from a thread, after any write already in progress. Returns a Deferred."""
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        data = ''.join(self._pending)
+        self._pending = list()
+        d = self._write_lock.run(threads.deferToThread, self._write, data)
+        d.addErrback(lambda failure: log.error("Could not write trade tape %s: %s" %
+                                               (self.path, failure.getErrorMessage())))
+        return d
+
+    def _write(self, data):
+        with open(self.path, 'ab') as f:
+            f.write(data)
+
+    def stop(self):
+        """Write the remaining trades once the write in progress is done. Returns a Deferred."""
+        self._stopping = True
+        d = self.flush()
+        d.addCallback(self._close)
+        return d
+
+    def _close(self, _):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _records(self):
+        """Return (mmap, record count) covering everything written so far."""
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        size -= size % self.record.size
+        if size != self._map_size:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            if size:
+                with open(self.path, 'rb') as f:
+                    self._map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            self._map_size = size
+        return self._map, size // self.record.size
+
+    def _unpack(self, data, idx):
+        return self.record.unpack_from(data, idx * self.record.size)
+
+    def _bisect(self, data, count, timestamp):
+        """Index of the first record at or after timestamp."""
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._unpack(data, mid)[0] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _totals_before(self, data, idx):
+        if idx == 0:
+            return 0.0, 0.0
+        record = self._unpack(data, idx - 1)
+        return record[3], record[4]
+
+    def __len__(self):
+        return self._records()[1]
+
+    def totals(self, start_ms, end_ms):
+        """Return (volume, notional) of trades with start_ms <= timestamp < end_ms."""
+        data, count = self._records()
+        if not count:
+            return 0.0, 0.0
+        start_vol, start_notional = self._totals_before(data, self._bisect(data, count, start_ms))
+        end_vol, end_notional = self._totals_before(data, self._bisect(data, count, end_ms))
+        return end_vol - start_vol, end_notional - start_notional
+
+    def volume(self, start_ms, end_ms):
+        return self.totals(start_ms, end_ms)[0]
+
+    def vwap(self, start_ms, end_ms):
+        """Volume weighted average price between two times, or None if nothing traded."""
+        volume, notional = self.totals(start_ms, end_ms)
+        if volume > 0:
+            return notional / volume
+
+    def trades(self, start_ms, end_ms):
+        """Generate Trades with start_ms <= timestamp < end_ms."""
+        data, count = self._records()
+        if not count:
+            return
+        for idx in xrange(self._bisect(data, count, start_ms), self._bisect(data, count, end_ms)):
+            timestamp, price, amount, _, _, side = self._unpack(data, idx)
+            is_buy = None if side == SIDE_UNKNOWN else side == SIDE_BUY
+            yield Trade(amount, price, timestamp, is_buy)
@@ -9,6 +9,7 @@ from twisted.protocols import basic
 from twobitbot.utils import configure
 from twobitbot.botresponder import BotResponder
 from twobitbot.bitstampwatcher import BitstampWatcher
+from twobitbot.exchangewatcher import WatcherRegistry
 
 log = logging.getLogger("termbot")
 
@@ -29,7 +30,7 @@ class TerminalBot(basic.LineReceiver):
 
     def __init__(self, config):
         self.config = config
-        self.watcher = BitstampWatcher()
+        self.watcher = WatcherRegistry([BitstampWatcher()])
         self.watcher.add_alert_callback(self.out)
         self.responder = BotResponder(self.config, self.watcher)
 
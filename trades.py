@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+import logging
+from array import array
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+
+SIDE_SELL = 0
+SIDE_BUY = 1
+SIDE_UNKNOWN = -1
+
+
+def side_from_is_buy(is_buy):
+    if is_buy is True:
+        return SIDE_BUY
+    elif is_buy is False:
+        return SIDE_SELL
+    return SIDE_UNKNOWN
+
+
+class Trade(object):
+    """Lightweight view of a single trade, e.g. a row of a TradeBuffer."""
+    __slots__ = ('amount', 'price', 'timestamp', 'is_buy')
+
+    def __init__(self, amount=0, price=0, timestamp=None, is_buy=None):
+        self.amount = amount
+        self.price = price
+        self.timestamp = timestamp
+        self.is_buy = is_buy
+
+    def __repr__(self):
+        return "Trade(amount=%r, price=%r, timestamp=%r, is_buy=%r)" % \
+               (self.amount, self.price, self.timestamp, self.is_buy)
+
+
+class TradeBuffer(object):
+    """Fixed capacity ring buffer of trades, stored column-wise in compact arrays.
+
+    Each buffered trade costs 25 bytes (three doubles and a signed char) instead of a dict.
+    Rows are addressed by a monotonically increasing sequence number, so callers can hold on to
+    positions while older rows are dropped from the left."""
+
+    def __init__(self, capacity=4096):
+        if capacity <= 0:
+            raise ValueError("TradeBuffer capacity must be positive.")
+        self.capacity = capacity
+        self.amounts = array('d', [0.0]) * capacity
+        self.prices = array('d', [0.0]) * capacity
+        # ms timestamps; doubles hold integers exactly up to 2**53
+        self.timestamps = array('d', [0.0]) * capacity
+        self.sides = array('b', [SIDE_UNKNOWN]) * capacity
+        # sequence number of the oldest row, and of the next row to be appended
+        self.head = 0
+        self.tail = 0
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def is_full(self):
+        return len(self) == self.capacity
+
+    def append(self, amount, price, timestamp, is_buy):
+        """Append a trade and return its sequence number. Raises IndexError if the buffer is full."""
+        if self.is_full():
+            raise IndexError("TradeBuffer is full.")
+        seq = self.tail
+        i = seq % self.capacity
+        self.amounts[i] = amount
+        self.prices[i] = price
+        self.timestamps[i] = timestamp
+        self.sides[i] = side_from_is_buy(is_buy)
+        self.tail += 1
+        return seq
+
+    def popleft(self):
+        """Drop the oldest trade, returning its sequence number."""
+        if self.head == self.tail:
+            raise IndexError("popleft from empty TradeBuffer.")
+        seq = self.head
+        self.head += 1
+        return seq
+
+    def clear(self):
+        self.head = self.tail
+
+    def row(self, seq):
+        """Index into the columns for a buffered sequence number."""
+        if not self.head <= seq < self.tail:
+            raise IndexError("Trade %d is not buffered." % (seq))
+        return seq % self.capacity
+
+    def __getitem__(self, seq):
+        i = self.row(seq)
+        side = self.sides[i]
+        is_buy = None if side == SIDE_UNKNOWN else side == SIDE_BUY
+        return Trade(self.amounts[i], self.prices[i], int(self.timestamps[i]), is_buy)
+
+    def __iter__(self):
+        for seq in xrange(self.head, self.tail):
+            yield self[seq]
+
+    def column(self, name):
+        """Return the buffered values of a column ('amounts', 'prices', 'timestamps' or 'sides')
+        as a single array, oldest first."""
+        col = getattr(self, name)
+        if not len(self):
+            return col[:0]
+        start = self.head % self.capacity
+        end = start + len(self)
+        if end <= self.capacity:
+            return col[start:end]
+        return col[start:] + col[:end - self.capacity]
+
+    def side_volume(self, side):
+        """Total amount traded on one side, computed with a scan over the columns."""
+        return sum(amt for amt, s in zip(self.column('amounts'), self.column('sides')) if s == side)
+
+
+class RollingTradeWindow(object):
+    """Time-limited window over recent trades that keeps its aggregates up to date as trades come and go.
+
+    Buy/sell volume are running sums, and the highest buy/lowest sell prices are tracked with
+    monotonic deques, so adding or expiring a trade is O(1) amortized and reading the aggregates never
+    has to copy or scan the window. Trades themselves live in a TradeBuffer; if it fills up the oldest
+    trades are expired early."""
+
+    def __init__(self, timelimit_ms=15000, capacity=4096):
+        self.timelimit_ms = timelimit_ms
+        self.trades = TradeBuffer(capacity)
+        self.buyvol = 0
+        self.sellvol = 0
+        # sequence numbers with decreasing prices for buys and increasing prices for sells
+        self._buy_highs = deque()
+        self._sell_lows = deque()
+
+    def __len__(self):
+        return len(self.trades)
+
+    def __iter__(self):
+        return iter(self.trades)
+
+    @property
+    def total(self):
+        return self.buyvol + self.sellvol
+
+    @property
+    def high(self):
+        """Highest price among buys in the window, 0 if there are none."""
+        if self._buy_highs:
+            return self.trades.prices[self.trades.row(self._buy_highs[0])]
+        return 0
+
+    @property
+    def low(self):
+        """Lowest price among sells in the window, 0 if there are none."""
+        if self._sell_lows:
+            return self.trades.prices[self.trades.row(self._sell_lows[0])]
+        return 0
+
+    def add(self, amount, price, timestamp, is_buy):
+        """Add a trade to the newest end of the window. Trades of unknown side (is_buy None) are kept,
+        but count toward neither buy nor sell volume."""
+        if self.trades.is_full():
+            log.debug("Trade window full at %d trades, expiring oldest early" % (len(self.trades)))
+            self._popleft()
+        seq = self.trades.append(amount, price, timestamp, is_buy)
+        # use the stored values so the running sums match what gets subtracted later
+        i = self.trades.row(seq)
+        amount, price = self.trades.amounts[i], self.trades.prices[i]
+        prices = self.trades.prices
+
+        if is_buy:
+            self.buyvol += amount
+            while self._buy_highs and prices[self.trades.row(self._buy_highs[-1])] <= price:
+                self._buy_highs.pop()
+            self._buy_highs.append(seq)
+        elif is_buy is not None:
+            self.sellvol += amount
+            while self._sell_lows and prices[self.trades.row(self._sell_lows[-1])] >= price:
+                self._sell_lows.pop()
+            self._sell_lows.append(seq)
+
+    def expire(self):
+        """Remove trades more than timelimit_ms older than the most recent trade."""
+        buf = self.trades
+        if not len(buf):
+            return
+        newest = buf.timestamps[buf.row(buf.tail - 1)]
+        while newest - buf.timestamps[buf.row(buf.head)] > self.timelimit_ms:
+            self._popleft()
+
+    def _popleft(self):
+        buf = self.trades
+        i = buf.row(buf.head)
+        seq = buf.popleft()
+        if buf.sides[i] == SIDE_BUY:
+            self.buyvol -= buf.amounts[i]
+            if self._buy_highs and self._buy_highs[0] == seq:
+                self._buy_highs.popleft()
+        elif buf.sides[i] == SIDE_SELL:
+            self.sellvol -= buf.amounts[i]
+            if self._sell_lows and self._sell_lows[0] == seq:
+                self._sell_lows.popleft()
+        if not len(buf):
+            # don't let floating point error accumulate across bursts
+            self.buyvol = self.sellvol = 0
+
+    def clear(self):
+        self.trades.clear()
+        self._buy_highs.clear()
+        self._sell_lows.clear()
+        self.buyvol = 0
+        self.sellvol = 0
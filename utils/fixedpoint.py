@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+import logging
+from decimal import Decimal, ROUND_DOWN as DECIMAL_ROUND_DOWN, ROUND_HALF_UP as DECIMAL_ROUND_HALF_UP
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger(__name__)
+
+# Fixed-point money: amounts are plain ints counting the smallest unit we track.
+# BTC amounts are in units of 0.0001 BTC, USD amounts and prices (USD per BTC) in cents,
+# which matches how flair has always stored them in its DB.
+BTC_PIP = 10000
+USD_PIP = 100
+
+# Rounding rules. Anything that hands a user a balance rounds down, so converting back and forth
+# never creates money; valuations and percentages for display round half up.
+ROUND_DOWN = 'down'
+ROUND_HALF_UP = 'half_up'
+
+
+def div_round(num, den, rounding=ROUND_HALF_UP):
+    """Divide non-negative ints, rounding as specified."""
+    if rounding == ROUND_DOWN:
+        return num // den
+    elif rounding == ROUND_HALF_UP:
+        return (2 * num + den) // (2 * den)
+    raise ValueError("Unknown rounding: %s" % (rounding))
+
+
+def to_units(amount, pip, rounding=ROUND_HALF_UP):
+    """Convert a Decimal (or anything Decimal accepts, like a str) to an int number of 1/pip units."""
+    mode = DECIMAL_ROUND_DOWN if rounding == ROUND_DOWN else DECIMAL_ROUND_HALF_UP
+    if isinstance(amount, float):
+        amount = repr(amount)
+    return int((Decimal(amount) * pip).to_integral_value(rounding=mode))
+
+
+def to_cents(usd):
+    return to_units(usd, USD_PIP)
+
+
+def format_units(units, pip, places):
+    """Format an amount in 1/pip units with a fixed number of decimal places, e.g. for %.2f-style output."""
+    sign = '-' if units < 0 else ''
+    units = abs(units)
+    scale = 10 ** places
+    # rescale to the requested number of places, rounding half up
+    if scale >= pip:
+        scaled = units * (scale // pip)
+    else:
+        scaled = div_round(units, pip // scale)
+    whole, frac = divmod(scaled, scale)
+    if places:
+        return "%s%d.%0*d" % (sign, whole, places, frac)
+    return "%s%d" % (sign, whole)
+
+
+def format_cents(cents):
+    return format_units(cents, USD_PIP, 2)
+
+
+def format_btc(btc_units):
+    return format_units(btc_units, BTC_PIP, 4)
+
+
+def btc_value_cents(btc_units, price_cents):
+    """USD value in cents of a BTC amount at a price."""
+    return div_round(btc_units * price_cents, BTC_PIP)
+
+
+def btc_to_usd(btc_units, price_cents):
+    """Cents received for selling a BTC amount at a price."""
+    return div_round(btc_units * price_cents, BTC_PIP, ROUND_DOWN)
+
+
+def usd_to_btc(usd_cents, price_cents):
+    """BTC units received for buying with an amount of cents at a price."""
+    return div_round(usd_cents * BTC_PIP, price_cents, ROUND_DOWN)
+
+
+def ratio_bp(num, den):
+    """num/den - 1 in basis points, e.g. the return from buying at den and selling at num."""
+    return div_round(num * 10000, den) - 10000
+
+
+def format_bp(bp):
+    """Format basis points as a percentage with two decimal places, e.g. 123 -> '1.23'."""
+    return format_units(bp, 100, 2)
+
+
+def btc_values_cents(btc_units, price_cents):
+    """Value many BTC amounts at one price. Takes any sequence of ints, and uses numpy if it's available.
+    Returns a list of cents."""
+    if numpy is not None and len(btc_units) > 64:
+        values = numpy.asarray(btc_units, dtype=numpy.int64) * price_cents
+        return ((2 * values + BTC_PIP) // (2 * BTC_PIP)).tolist()
+    return [(2 * units * price_cents + BTC_PIP) // (2 * BTC_PIP) for units in btc_units]
+
+
+def ratios_bp(nums, dens):
+    """ratio_bp for each pair from two sequences of ints, using numpy if it's available.
+    Pairs with a zero denominator give 0. Returns a list of basis points."""
+    if numpy is not None and len(nums) > 64:
+        nums = numpy.asarray(nums, dtype=numpy.int64)
+        dens = numpy.asarray(dens, dtype=numpy.int64)
+        safe = numpy.where(dens == 0, 1, dens)
+        values = (nums * 20000 + safe) // (2 * safe) - 10000
+        return numpy.where(dens == 0, 0, values).tolist()
+    return [(num * 20000 + den) // (2 * den) - 10000 if den else 0 for num, den in zip(nums, dens)]
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+import cPickle as pickle
+import datetime
+import logging
+import os
+from collections import OrderedDict
+
+from twisted.internet import defer, reactor, task, threads
+
+try:
+    import pytz
+except ImportError:
+    pytz = None
+
+log = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    """Mapping of at most `size` entries, evicting the least recently used when full."""
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            return default
+        # reinserting moves it to the most recently used end
+        self._entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def discard(self, key):
+        self._entries.pop(key, None)
+
+    def items(self):
+        """(key, value) pairs from least to most recently used."""
+        return self._entries.items()
+
+
+class GeoCache(object):
+    """Remembers where locations are and which timezone they are in, for !time.
+
+    Location names map to coordinates until they are evicted, since places don't move. Coordinates map to
+    the timezone Google reported for them. With pytz installed the offset is worked out from the zone's
+    rules for any time, so DST is always right and the entry never goes stale. Without it, the offset
+    Google gave is only trusted until the next whole hour of local time, as DST never changes mid-hour."""
+
+    def __init__(self, path=None, size=2000, checkpoint_interval=10*60):
+        self.path = path
+        # normalized location name -> dict with 'lat', 'lng' and 'loc', like lookup_geocode returns
+        self.geocodes = LRUCache(size)
+        # rounded (lat, lng) -> (zone id or None, offset in seconds, UTC secs when it was looked up)
+        self.timezones = LRUCache(size)
+        self._dirty = False
+
+        self.checkpointer = None
+        if self.path:
+            self.load()
+            self.checkpointer = task.LoopingCall(self.checkpoint)
+            self.checkpointer.start(checkpoint_interval, now=False)
+            reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        if self.checkpointer is not None and self.checkpointer.running:
+            self.checkpointer.stop()
+        if self.path and self._dirty:
+            self._write(self._dump())
+
+    @staticmethod
+    def _location_key(location):
+        return ' '.join(location.lower().split())
+
+    @staticmethod
+    def _coords_key(geocode):
+        # about 100m, far finer than any timezone boundary cares about
+        return round(float(geocode['lat']), 3), round(float(geocode['lng']), 3)
+
+    def geocode(self, location):
+        """Cached geocode for a location name, or None."""
+        return self.geocodes.get(self._location_key(location))
+
+    def put_geocode(self, location, geocode):
+        self.geocodes.put(self._location_key(location), geocode)
+        self._dirty = True
+
+    def offset(self, geocode, utc_secs):
+        """UTC offset in seconds at the geocode's coordinates at utc_secs, or None if it must be looked up."""
+        key = self._coords_key(geocode)
+        entry = self.timezones.get(key)
+        if entry is None:
+            return None
+        zone, offset, looked_up = entry
+        if zone and pytz is not None:
+            try:
+                tz = pytz.timezone(zone)
+            except pytz.UnknownTimeZoneError:
+                pass
+            else:
+                utc_time = pytz.utc.localize(datetime.datetime.utcfromtimestamp(utc_secs))
+                delta = utc_time.astimezone(tz).utcoffset()
+                return delta.days * 24*60*60 + delta.seconds
+        if looked_up <= utc_secs < self._next_local_hour(looked_up, offset):
+            return offset
+        self.timezones.discard(key)
+        return None
+
+    @staticmethod
+    def _next_local_hour(utc_secs, offset):
+        """UTC secs at which the next whole hour starts in a zone offset from UTC by `offset` seconds."""
+        return utc_secs + 60*60 - (utc_secs + offset) % (60*60)
+
+    def put_timezone(self, geocode, zone, offset, utc_secs):
+        """Remember the timezone and its UTC offset at utc_secs for a geocode's coordinates."""
+        self.timezones.put(self._coords_key(geocode), (zone, offset, utc_secs))
+        self._dirty = True
+
+    def _dump(self):
+        self._dirty = False
+        return pickle.dumps({'geocodes': self.geocodes.items(), 'timezones': self.timezones.items()},
+                            pickle.HIGHEST_PROTOCOL)
+
+    def _write(self, data):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp, self.path)
+
+    def checkpoint(self):
+        """Write the cache to disk from a thread if it has changed. Returns a Deferred."""
+        if not self._dirty:
+            return defer.succeed(None)
+        d = threads.deferToThread(self._write, self._dump())
+        d.addErrback(lambda failure: log.error("Could not checkpoint geocode cache to %s: %s" %
+                                               (self.path, failure.getErrorMessage())))
+        return d
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                state = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError) as e:
+            log.error("Could not load geocode cache from %s: %s" % (self.path, e))
+            return
+        for key, geocode in state['geocodes']:
+            self.geocodes.put(key, geocode)
+        for key, entry in state['timezones']:
+            self.timezones.put(key, entry)
+        log.info("Loaded %d geocodes and %d timezones from %s" %
+                 (len(self.geocodes), len(self.timezones), self.path))
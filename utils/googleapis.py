@@ -1,19 +1,24 @@
 #!/usr/bin/env python
 
 import logging
+import calendar
 import datetime
-import treq
 
-from twisted.internet import defer
+from twisted.internet import defer, error
 
 from twobitbot.utils.misc import now_in_utc_secs
+from twobitbot.utils.httpclient import shared_client
 
 log = logging.getLogger(__name__)
 
 # todo raise errors on failure...
 
+# errors making a request that are logged rather than raised
+REQUEST_ERRORS = (error.TimeoutError, error.ConnectError, error.DNSLookupError)
+
+
 @defer.inlineCallbacks
-def lookup_localized_time(location, utc_time, google_api_key=''):
+def lookup_localized_time(location, utc_time, google_api_key='', cache=None, client=None):
     """
     Lookup the time in a location.
     :param location: location name
@@ -25,13 +30,31 @@ def lookup_localized_time(location, utc_time, google_api_key=''):
     :param google_api_key: optional API key for Google API calls
     :type google_api_key: str
 
+    :param cache: optional cache of earlier lookups, which answers repeat lookups without any API calls
+    :type cache: twobitbot.utils.geocache.GeoCache
+
+    :param client: HTTP client to make API calls with, defaulting to the shared one
+    :type client: twobitbot.utils.httpclient.HTTPClient
+
     :return: a dict containing keys 'time' which is localized time as a datetime object,
             and 'location' which is the location name returned by Google.
     @rtype: defer.Deferred
     """
-    geocode = yield lookup_geocode(location, google_api_key)
+    geocode = cache.geocode(location) if cache is not None else None
+    if geocode is None:
+        geocode = yield lookup_geocode(location, google_api_key, client)
+        if geocode and cache is not None:
+            cache.put_geocode(location, geocode)
     if geocode:
-        tz = yield lookup_timezone(geocode, google_api_key)
+        utc_secs = calendar.timegm(utc_time.utctimetuple())
+        tz = cache.offset(geocode, utc_secs) if cache is not None else None
+        if tz is None:
+            info = yield lookup_timezone_info(geocode, google_api_key, utc_secs, client)
+            if info is None:
+                defer.returnValue(None)
+            tz = info['offset']
+            if cache is not None:
+                cache.put_timezone(geocode, info['zone'], tz, utc_secs)
         try:
             new_time = utc_time+datetime.timedelta(seconds=tz)
         except TypeError:
@@ -42,23 +65,24 @@ def lookup_localized_time(location, utc_time, google_api_key=''):
 
 
 @defer.inlineCallbacks
-def lookup_geocode(location, api_key=''):
+def lookup_geocode(location, api_key='', client=None):
     """
     Determine the lat/long coordinates for a location name.
 
     :param location: location name
     :type location: str
     :type api_key: str
+    :param client: HTTP client to use, defaulting to the shared one
 
     :return: a dict with keys 'lat', 'lng', 'loc' that contain
      the lat/long coordinates and placename for the location.
     :rtype: defer.Deferred
     """
+    client = client or shared_client()
     try:
-        res = yield treq.get("http://maps.googleapis.com/maps/api/geocode/json",
-                             params={'address': location, 'sensor': 'false', 'key': api_key})
-        if res and res.code == 200:
-            data = yield treq.json_content(res)
+        code, data = yield client.get_json("http://maps.googleapis.com/maps/api/geocode/json",
+                                           params={'address': location, 'sensor': 'false', 'key': api_key})
+        if code == 200 and data:
             if data['status'] == 'OK':
                 # API returned at least one geocode
                 ret = data['results'][0]['geometry']['location']
@@ -66,38 +90,66 @@ def lookup_geocode(location, api_key=''):
                 defer.returnValue(ret)
             else:
                 log.warn("Bad status response from Google Geocode API: %s" % (data['status']))
-        elif res is not None:
-            log.warn("Bad HTTP status from Google Geocode API: %s" % (res.code))
+        else:
+            log.warn("Bad HTTP status from Google Geocode API: %s" % (code))
     except TypeError:
         log.warn("Bad location passed to lookup_geocode", exc_info=True)
+    except REQUEST_ERRORS as e:
+        log.warn("Could not reach Google Geocode API: %s" % (e))
 
 
 @defer.inlineCallbacks
-def lookup_timezone(loc, api_key=''):
+def lookup_timezone(loc, api_key='', client=None):
     """
     Determine the timezone of a lat/long pair.
 
     @param loc: lat/long coordinates of a location
     @type loc: dict
     @type api_key: str
+    @param client: HTTP client to use, defaulting to the shared one
 
     @rtype: defer.Deferred yielding a second offset representing the timezone
     """
+    info = yield lookup_timezone_info(loc, api_key, client=client)
+    if info is not None:
+        defer.returnValue(info['offset'])
+
+
+@defer.inlineCallbacks
+def lookup_timezone_info(loc, api_key='', timestamp=None, client=None):
+    """
+    Determine the timezone of a lat/long pair at a given time.
+
+    @param loc: lat/long coordinates of a location
+    @type loc: dict
+    @type api_key: str
+    @param timestamp: UTC secs to get the offset at, defaulting to now
+    @param client: HTTP client to use, defaulting to the shared one
+
+    @rtype: defer.Deferred yielding a dict with keys 'zone', the timezone ID such as 'Europe/London',
+     and 'offset', the second offset from UTC including DST
+    """
+    if timestamp is None:
+        timestamp = now_in_utc_secs()
+    client = client or shared_client()
     try:
-        res = yield treq.get(("https://maps.googleapis.com/maps/api/timezone/json"),
-                             params={'location': str(loc['lat']) + ',' + str(loc['lng']),
-                                     'timestamp': str(now_in_utc_secs()), 'sensor': 'false', 'key': api_key})
-        if res and res.code == 200:
-            data = yield treq.json_content(res)
+        code, data = yield client.get_json("https://maps.googleapis.com/maps/api/timezone/json",
+                                           params={'location': str(loc['lat']) + ',' + str(loc['lng']),
+                                                   'timestamp': str(timestamp), 'sensor': 'false',
+                                                   'key': api_key})
+        if code == 200 and data:
             if data['status'] == 'OK':
-                # API returned timezone info. What we care about: rawOffset
-                defer.returnValue(int(data['rawOffset'])+int(data['dstOffset']))
+                # API returned timezone info. What we care about: rawOffset and dstOffset
+                defer.returnValue({'zone': data.get('timeZoneId'),
+                                   'offset': int(data['rawOffset'])+int(data['dstOffset'])})
             else:
                 log.warn("Bad status response from Google Geocode API: %s" % (data['status']))
-        elif res is not None:
-            log.warn("Bad HTTP status from Google Timezone API: %s" % (res.code))
+        else:
+            log.warn("Bad HTTP status from Google Timezone API: %s" % (code))
     except TypeError:
         log.warn("Bad lat/long parameter passed to lookup_timezone: %s" % (loc), exc_info=True)
+    except REQUEST_ERRORS as e:
+        log.warn("Could not reach Google Timezone API: %s" % (e))
 
 
 
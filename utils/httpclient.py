@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import urlparse
+
+import treq
+from twisted.internet import defer, error
+from twisted.python import failure
+from twisted.web.client import HTTPConnectionPool
+
+log = logging.getLogger(__name__)
+
+
+class HTTPClient(object):
+    """HTTP client shared by outbound API calls.
+
+    Connections are kept open in a pool and reused, so repeat calls to an API skip the TCP and TLS handshakes.
+    A GET made while an identical one is in flight waits for that one's response instead of making its own,
+    requests to each host are limited to `per_host` at a time, and each request gives up after `timeout` secs."""
+
+    def __init__(self, reactor=None, per_host=4, timeout=10, idle_timeout=4*60):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.per_host = per_host
+        self.timeout = timeout
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = per_host
+        self.pool.cachedConnectionTimeout = idle_timeout
+        # (url, params) -> Deferreds waiting on the request in flight for it
+        self._in_flight = dict()
+        # host -> DeferredSemaphore limiting requests to it
+        self._host_limits = dict()
+
+    def close(self):
+        """Close idle pooled connections. Returns a Deferred."""
+        return self.pool.closeCachedConnections()
+
+    def get(self, url, params=None):
+        """GET url with query parameters params, a dict.
+        Returns a Deferred firing with (HTTP status code, response body as a str)."""
+        key = (url, tuple(sorted((params or {}).items())))
+        d = defer.Deferred()
+        waiting = self._in_flight.get(key)
+        if waiting is not None:
+            waiting.append(d)
+            return d
+        self._in_flight[key] = [d]
+
+        host = urlparse.urlsplit(url).netloc
+        limit = self._host_limits.get(host)
+        if limit is None:
+            limit = self._host_limits[host] = defer.DeferredSemaphore(self.per_host)
+        limit.run(self._fetch, url, params).addBoth(self._fetched, key)
+        return d
+
+    def get_json(self, url, params=None):
+        """Like get, but fires with (HTTP status code, decoded JSON body or None if it isn't JSON).
+        Each caller gets its own copy of the body, so they can change it freely."""
+        return self.get(url, params).addCallback(self._decode_json, url)
+
+    @staticmethod
+    def _decode_json(response, url):
+        code, body = response
+        try:
+            return code, json.loads(body)
+        except ValueError:
+            log.warn("Response from %s with HTTP status %s is not JSON" % (url, code))
+            return code, None
+
+    def _fetch(self, url, params):
+        d = treq.get(url, params=params, pool=self.pool)
+        d.addCallback(lambda res: treq.content(res).addCallback(lambda body: (res.code, body)))
+        timer = self.reactor.callLater(self.timeout, d.cancel)
+
+        def done(result):
+            if timer.active():
+                timer.cancel()
+            elif isinstance(result, failure.Failure):
+                # cancelling fails in different ways depending on how far the request got
+                raise error.TimeoutError(string="GET %s took over %ss" % (url, self.timeout))
+            return result
+        return d.addBoth(done)
+
+    def _fetched(self, result, key):
+        for d in self._in_flight.pop(key):
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+
+_shared = None
+
+
+def shared_client():
+    """HTTPClient for all outbound API calls, created when first used and closed when the reactor stops."""
+    global _shared
+    if _shared is None:
+        from twisted.internet import reactor
+        _shared = HTTPClient(reactor)
+        reactor.addSystemEventTrigger('before', 'shutdown', _shared.close)
+    return _shared
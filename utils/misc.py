@@ -67,6 +67,29 @@ def now_in_utc_secs():
     return int(calendar.timegm(time.gmtime()))
 
 
+def now_in_utc_ms():
+    return int(time.time()*1000)
+
+
+def parse_duration(duration):
+    """Parse a duration like '90s', '15m', '1h' or '7d' into seconds. A bare number is taken as minutes.
+    Returns None if the duration is invalid."""
+    units = {'s': 1, 'm': 60, 'h': 60*60, 'd': 24*60*60}
+    duration = duration.strip().lower()
+    if duration and duration[-1] in units:
+        mult = units[duration[-1]]
+        duration = duration[:-1]
+    else:
+        mult = units['m']
+    try:
+        amount = int(duration)
+    except ValueError:
+        return None
+    if amount <= 0:
+        return None
+    return amount * mult
+
+
 def truncatefloat(num):
     """Takes a float, returns a string. Return value is capped at 2 digits after the decimal and
     trailing zeros are removed, as well as the decimal if nothing but 0s after it."""
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+import codecs
+import logging
+import os
+import re
+from bisect import bisect_left
+from collections import defaultdict
+
+try:
+    import pytz
+except ImportError:
+    pytz = None
+
+log = logging.getLogger(__name__)
+
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gazetteer.tsv')
+
+# Other names people qualify places with, by country code, besides the tz database's country names.
+COUNTRY_ALIASES = {
+    'GB': ['uk', 'united kingdom', 'great britain', 'england', 'scotland', 'wales', 'northern ireland'],
+    'US': ['usa', 'united states of america', 'america'],
+}
+
+
+def normalize(name):
+    """Lowercase a place name and reduce it to words of letters and digits, e.g. 'St. Louis' to 'st louis'."""
+    return ' '.join(re.findall(r'[^\W_]+', name.lower(), re.UNICODE))
+
+
+def trigrams(key):
+    """Set of the three letter substrings of a normalized name, padded so the ends count too."""
+    key = ' %s ' % (key)
+    return set(key[i:i+3] for i in xrange(len(key) - 2))
+
+
+def similarity(a, b):
+    """Dice coefficient of two normalized names' trigrams, from 0 to 1."""
+    a, b = trigrams(a), trigrams(b)
+    return 2.0 * len(a & b) / (len(a) + len(b))
+
+
+class PlaceIndex(object):
+    """Places by name, found by exact name, by a unique enough prefix, or by trigram similarity to catch typos.
+    The first place added under a name keeps it.
+
+    Inexact matches have to account for the whole name given, word for word: 'san fr' finds 'san francisco'
+    and 'san fransisco' does too, but 'cambridge' doesn't find 'cambridge bay', nor 'cambridge ma'."""
+
+    def __init__(self, min_prefix=4, min_similarity=0.5):
+        self.min_prefix = min_prefix
+        self.min_similarity = min_similarity
+        # normalized name -> place
+        self.places = dict()
+        # trigram -> normalized names containing it, and how many distinct trigrams each name has
+        self._trigrams = defaultdict(list)
+        self._trigram_counts = dict()
+        # sorted normalized names for prefix searches, rebuilt after adding
+        self._sorted = None
+
+    def __len__(self):
+        return len(self.places)
+
+    def add(self, name, place, fuzzy=True):
+        """Add a place under a name. Unless fuzzy, the name has to be given exactly or by prefix to find it."""
+        key = normalize(name)
+        if not key or key in self.places:
+            return
+        self.places[key] = place
+        self._sorted = None
+        if not fuzzy:
+            return
+        key_trigrams = trigrams(key)
+        for trigram in key_trigrams:
+            self._trigrams[trigram].append(key)
+        self._trigram_counts[key] = len(key_trigrams)
+
+    def find(self, name):
+        """Place best matching name, or None."""
+        key = normalize(name)
+        if not key:
+            return None
+        if key in self.places:
+            return self.places[key]
+        match = self._by_prefix(key) or self._by_similarity(key)
+        if match is not None:
+            return self.places[match]
+
+    def _by_prefix(self, key):
+        """Shortest name with as many words as key that starts with it, e.g. 'san fr' for 'san francisco'."""
+        if len(key) < self.min_prefix:
+            return None
+        if self._sorted is None:
+            self._sorted = sorted(self.places)
+        words = key.count(' ')
+        matches = list()
+        i = bisect_left(self._sorted, key)
+        while i < len(self._sorted) and self._sorted[i].startswith(key):
+            if self._sorted[i].count(' ') == words:
+                matches.append(self._sorted[i])
+            i += 1
+        if matches:
+            return min(matches, key=lambda name: (len(name), name))
+
+    def _same_words(self, key, name):
+        """Whether name could be key with typos: as many words, with words too short to judge spelled the same."""
+        key_words, name_words = key.split(), name.split()
+        if len(key_words) != len(name_words):
+            return False
+        return all(a == b or (len(a) >= self.min_prefix and len(b) >= self.min_prefix)
+                   for a, b in zip(key_words, name_words))
+
+    def _by_similarity(self, key):
+        """Most similar name by the Dice coefficient of their trigrams, if similar enough."""
+        query = trigrams(key)
+        shared = defaultdict(int)
+        for trigram in query:
+            for name in self._trigrams.get(trigram, ()):
+                shared[name] += 1
+        best, best_score = None, self.min_similarity
+        for name, count in shared.iteritems():
+            if not self._same_words(key, name):
+                continue
+            score = 2.0 * count / (len(query) + self._trigram_counts[name])
+            if score > best_score or (score == best_score and best is not None and
+                                      (len(name), name) < (len(best), best)):
+                best, best_score = name, score
+        return best
+
+
+class TimezoneResolver(object):
+    """Works out the time in a place without network access, from the tz database and a bundled gazetteer.
+
+    Places are every city named by a timezone (Europe/London is London), countries with one timezone, and
+    the places in gazetteer.tsv. The UTC offset comes from the zone's rules, so DST is handled exactly.
+
+    A place can be qualified, as in 'Paris, France' or 'Paris Texas'. The qualifier has to name the place's
+    region or country, or the location isn't resolved, since it is most likely somewhere not in the gazetteer.
+    Nor are names of countries and regions with no timezone of their own, like Australia. Google is better
+    placed to answer for those."""
+
+    def __init__(self, gazetteer=GAZETTEER_PATH):
+        if pytz is None:
+            raise ImportError("pytz is required to look up timezones offline.")
+        self.index = PlaceIndex()
+        self.zone_countries = dict()
+        self.zone_codes = dict()
+        # normalized names of countries and regions, which are only ever matched exactly
+        self.regions = set()
+        for code, zones in pytz.country_timezones.iteritems():
+            for zone in zones:
+                self.zone_countries.setdefault(zone, self._country_name(code))
+                self.zone_codes.setdefault(zone, code.upper())
+            if code in pytz.country_names:
+                self.regions.update(self._country_names(code.upper()))
+        self._add_zone_cities()
+        self._add_countries()
+        if gazetteer:
+            self._add_gazetteer(gazetteer)
+        self.region_index = PlaceIndex()
+        for region in self.regions:
+            self.region_index.add(region, region)
+        # (place name, timezone) -> normalized names of its region and country, see _place_regions
+        self._qualifiers = dict()
+        log.info("Loaded %d places for offline timezone lookups" % (len(self.index)))
+
+    @staticmethod
+    def _country_name(code):
+        # e.g. 'Britain (UK)' to 'Britain'
+        return re.sub(r'\s*\(.*\)', '', pytz.country_names[code])
+
+    @classmethod
+    def _country_names(cls, code):
+        """Normalized names a country goes by, e.g. 'britain uk', 'britain', 'gb', 'uk' and so on for GB."""
+        names = set([normalize(pytz.country_names[code]), normalize(cls._country_name(code)), code.lower()])
+        names.update(COUNTRY_ALIASES.get(code, ()))
+        return names
+
+    def _add_zone_cities(self):
+        for zone in pytz.common_timezones:
+            if '/' not in zone or zone.startswith('Etc/') or zone.startswith('US/') or zone.startswith('Canada/'):
+                continue
+            city = zone.rsplit('/', 1)[1].replace('_', ' ')
+            country = self.zone_countries.get(zone)
+            self.index.add(city, ('%s, %s' % (city, country) if country and country != city else city, zone))
+
+    def _add_countries(self):
+        for code, zones in pytz.country_timezones.iteritems():
+            if len(zones) == 1 and code in pytz.country_names:
+                name = self._country_name(code)
+                self.index.add(name, (name, zones[0]))
+                self.index.add(pytz.country_names[code], (name, zones[0]))
+
+    def _add_gazetteer(self, path):
+        with codecs.open(path, 'r', 'utf-8') as f:
+            for line in f:
+                line = line.rstrip('\r\n')
+                if not line or line.startswith('#'):
+                    continue
+                fields = line.split('\t')
+                name, zone = fields[0], fields[1]
+                if zone not in pytz.all_timezones_set:
+                    log.warn("Unknown timezone %s for %s in %s" % (zone, name, path))
+                    continue
+                place = (name, zone)
+                # matching 'Munich, Germany' fuzzily would make it the answer for 'Germany'
+                self.index.add(name, place, fuzzy=False)
+                self.regions.update(normalize(part) for part in name.split(',')[1:])
+                self.index.add(name.split(',', 1)[0], place)
+                if len(fields) > 2:
+                    for alias in fields[2].split(','):
+                        self.index.add(alias, place)
+
+    def _find(self, key):
+        """Place for a normalized name, or None. Region names have to match exactly, so 'Australia' isn't
+        taken for Austria, and neither are names closer to a region's than to the place found."""
+        if key in self.index.places:
+            return self.index.places[key]
+        if key in self.regions:
+            return None
+        match = self.index._by_prefix(key) or self.index._by_similarity(key)
+        if match is None:
+            return None
+        region = self.region_index._by_similarity(key)
+        if region is not None and region != match and similarity(key, region) >= similarity(key, match):
+            return None
+        return self.index.places[match]
+
+    def _place_regions(self, place):
+        """Normalized names that can qualify a place: the rest of its name after the first comma, and the
+        names of the country its timezone is in."""
+        regions = self._qualifiers.get(place)
+        if regions is None:
+            name, zone = place
+            regions = set(normalize(part) for part in name.split(',')[1:])
+            if zone in self.zone_codes:
+                regions.update(self._country_names(self.zone_codes[zone]))
+            self._qualifiers[place] = regions
+        return regions
+
+    @staticmethod
+    def _is_regions(words, regions):
+        """Whether a list of words is made up entirely of names in regions, e.g. 'oregon usa'."""
+        ends = set([0])
+        for start in xrange(len(words)):
+            if start in ends:
+                for end in xrange(start + 1, len(words) + 1):
+                    if ' '.join(words[start:end]) in regions:
+                        ends.add(end)
+        return len(words) in ends
+
+    def _qualified(self, key, qualifiers):
+        """Place for a normalized name if every qualifier names its region or country, otherwise None."""
+        place = self._find(key)
+        if place is None:
+            return None
+        regions = self._place_regions(place)
+        if all(self._is_regions(qualifier.split(), regions) for qualifier in qualifiers):
+            return place
+        return None
+
+    def resolve(self, location):
+        """(place name, timezone) for a location, or None if it isn't known."""
+        parts = [part for part in (normalize(part) for part in location.split(',')) if part]
+        if not parts:
+            return None
+        if ' '.join(parts) in self.index.places:
+            # full names from the gazetteer, like 'San Francisco, California'
+            return self.index.places[' '.join(parts)]
+        if len(parts) > 1:
+            # e.g. 'Paris, FR' is Paris, but 'Paris, Texas' isn't
+            return self._qualified(parts[0], parts[1:])
+        place = self._find(parts[0])
+        if place is not None:
+            return place
+        # e.g. 'Paris France', trying the longest place name first
+        words = parts[0].split()
+        for i in xrange(len(words) - 1, 0, -1):
+            place = self._qualified(' '.join(words[:i]), [' '.join(words[i:])])
+            if place is not None:
+                return place
+        return None
+
+    def localize(self, location, utc_time):
+        """Like googleapis.lookup_localized_time, but returns right away: a dict with 'time' in the location
+        as a datetime and 'location' as the place name, or None if the location isn't known."""
+        place = self.resolve(location)
+        if place is None:
+            return None
+        name, zone = place
+        local = pytz.utc.localize(utc_time).astimezone(pytz.timezone(zone))
+        return {'time': local.replace(tzinfo=None), 'location': name}
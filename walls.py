@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import logging
+from collections import deque
+
+from twobitbot import utils
+
+log = logging.getLogger(__name__)
+
+
+class Wall(object):
+    __slots__ = ('is_bid', 'price', 'peak', 'since', 'traded')
+
+    def __init__(self, is_bid, price, amount, since):
+        self.is_bid = is_bid
+        self.price = price
+        self.peak = amount
+        self.since = since
+        # volume traded at this price since the wall appeared
+        self.traded = 0
+
+
+class WallTracker(object):
+    """Detects large resting orders ("walls") in an OrderBook.
+
+    Hooked up as a level listener, so it only ever looks at levels that changed. Each changed level
+    gets a short amount history, and walls are reported when they appear, and when they disappear
+    either because they were traded through (eaten) or cancelled (pulled). Walls that only scroll
+    into or out of the order book snapshot's window as the price moves aren't reported."""
+
+    def __init__(self, orderbook, threshold, alert, history_len=20):
+        """threshold: minimum BTC resting at a level for it to count as a wall.
+        alert: callable that is passed (event, wall, amount) when a wall appears, is pulled or is eaten."""
+        self.threshold = threshold
+        self.alert = alert
+        self.history_len = history_len
+        # (is_bid, price) -> deque of (timestamp, amount)
+        self.history = dict()
+        self.walls = dict()
+        self.orderbook = orderbook
+        orderbook.add_level_listener(self.on_level_change)
+
+    def on_level_change(self, is_bid, price, old, new):
+        key = (is_bid, price)
+        now = utils.now_in_utc_secs()
+
+        if new > 0:
+            if key not in self.history:
+                self.history[key] = deque(maxlen=self.history_len)
+            self.history[key].append((now, new))
+        else:
+            self.history.pop(key, None)
+
+        wall = self.walls.get(key)
+        if wall is None:
+            if new >= self.threshold:
+                wall = self.walls[key] = Wall(is_bid, price, new, now)
+                # don't announce walls that were already there when the book was first loaded, or that
+                # were resting outside the snapshot until the price came to them
+                if self.orderbook.last_update is not None and self.orderbook.in_window(is_bid, price, previous=True):
+                    self.alert('appeared', wall, new)
+        elif new >= self.threshold:
+            wall.peak = max(wall.peak, new)
+        else:
+            del self.walls[key]
+            if new == 0 and not self.orderbook.in_window(is_bid, price):
+                # scrolled out of the snapshot, it may well still be there
+                return
+            # if most of what disappeared was traded away, it was eaten, otherwise it was cancelled
+            removed = wall.peak - new
+            if wall.traded * 2 >= removed:
+                self.alert('eaten', wall, wall.traded)
+            else:
+                self.alert('pulled', wall, removed)
+
+    def on_trade(self, price, amount):
+        """Called for each trade so walls can tell being eaten from being pulled.
+        Trades at a wall's price count toward it, and so do trades through it, i.e. below a bid wall or
+        above an ask wall, since those only happen once the wall has been filled."""
+        for wall in self.walls.itervalues():
+            if wall.price == price:
+                wall.traded += amount
+            elif (price < wall.price) if wall.is_bid else (price > wall.price):
+                # the fills at the wall's own price may not have been seen, but it was eaten all the same
+                wall.traded = max(wall.traded + amount, wall.peak)
+
+    def level_history(self, is_bid, price):
+        """List of (timestamp, amount) changes seen at a price level, oldest first."""
+        return list(self.history.get((is_bid, price), ()))